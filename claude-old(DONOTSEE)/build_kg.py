@@ -2,6 +2,7 @@
 Build knowledge graph from scratch
 Run all KG construction steps in sequence
 """
+import argparse
 import sys
 from pathlib import Path
 
@@ -10,17 +11,18 @@ project_root = Path(__file__).parent
 sys.path.insert(0, str(project_root))
 
 from config import config
-from src.gemini_client import GeminiClient
-from src.data_preprocessing import DataPreprocessor
-from src.entity_extraction import EntityExtractor
-from src.relationship_extraction import RelationshipExtractor
-from src.kg_builder import KnowledgeGraphBuilder
-from src.community_detection import CommunityDetector
-import networkx as nx
 
 
-def build_knowledge_graph():
-    """Build complete knowledge graph"""
+def build_knowledge_graph(write_graphml: bool = False):
+    """
+    Build complete knowledge graph
+    
+    Pipeline modules are imported inside each step, so --help and early
+    validation failures don't pay for loading the SDK, sklearn, etc.
+    
+    Args:
+        write_graphml: Also export the graph as GraphML for external tools
+    """
     
     print("="*60)
     print("RoleRAG-PAIMON 知识图谱构建")
@@ -37,8 +39,32 @@ def build_knowledge_graph():
     
     # Initialize Gemini client
     print("\n初始化 Gemini API 客户端...")
-    client = GeminiClient(config.GEMINI_API_KEY, config.GEMINI_MODEL)
-    
+    from src.gemini_client import GeminiClient, GeminiClientPool
+    from src.prompt_cache import PromptCache
+    cache = PromptCache(config.PROMPT_CACHE_DIR)
+    if config.GEMINI_FALLBACK_MODELS:
+        client = GeminiClientPool(
+            config.GEMINI_API_KEY, 
+            [config.GEMINI_MODEL, *config.GEMINI_FALLBACK_MODELS], 
+            config.LLM_CONCURRENCY,
+            cache=cache,
+            transport=config.GEMINI_TRANSPORT
+        )
+    else:
+        client = GeminiClient(
+            config.GEMINI_API_KEY, 
+            config.GEMINI_MODEL, 
+            config.LLM_CONCURRENCY,
+            cache=cache,
+            transport=config.GEMINI_TRANSPORT
+        )
+    
+    with client:
+        return _run_steps(client, write_graphml)
+
+
+def _run_steps(client, write_graphml: bool) -> bool:
+    """Run the build steps, sharing one Gemini client across them"""
     # Step 1: Data preprocessing
     print("\n" + "="*60)
     print("步骤 1: 数据预处理")
@@ -48,8 +74,9 @@ def build_knowledge_graph():
         print(f"错误: 数据文件不存在: {config.AVATAR_FILE}")
         return False
     
+    from src.data_preprocessing import DataPreprocessor
     preprocessor = DataPreprocessor(config.AVATAR_FILE)
-    chunks = preprocessor.process_all(chunk_size=config.CHUNK_SIZE)
+    chunks = preprocessor.process_all(chunk_size=config.CHUNK_SIZE, processes=config.PREPROCESS_PROCESSES)
     
     print(f"处理了 {len(preprocessor.processed_data)} 个角色")
     print(f"生成了 {len(chunks)} 个文本块")
@@ -70,6 +97,7 @@ def build_knowledge_graph():
         print("已取消")
         return False
     
+    from src.entity_extraction import EntityExtractor
     extractor = EntityExtractor(client)
     entities = extractor.process_chunks(chunks[:50])  # Limit to first 50 chunks for demo
     
@@ -81,8 +109,13 @@ def build_knowledge_graph():
     print("步骤 3: 关系提取")
     print("="*60)
     
-    rel_extractor = RelationshipExtractor(client)
-    relationships = rel_extractor.process_chunks(chunks[:50], entities)  # Same limit
+    from src.relationship_extraction import RelationshipExtractor
+    rel_extractor = RelationshipExtractor(client, automaton_file=config.KG_DIR / "entities.aho")
+    batch_file = config.OUTPUT_DIR / "relationship_batch_requests.jsonl" if config.USE_BATCH_API else None
+    relationships = rel_extractor.process_chunks(
+        chunks[:50], entities, batch_file=batch_file,  # Same limit
+        checkpoint_file=config.OUTPUT_DIR / "relationships_partial.jsonl"
+    )
     
     relationships_file = config.KG_DIR / "relationships.json"
     rel_extractor.save_relationships(relationships_file)
@@ -92,19 +125,23 @@ def build_knowledge_graph():
     print("步骤 4: 构建知识图谱并去重")
     print("="*60)
     
-    builder = KnowledgeGraphBuilder()
+    from src.kg_builder import KnowledgeGraphBuilder
+    builder = KnowledgeGraphBuilder(cache_dir=config.CACHE_DIR)
     builder.load_entities(entities_file)
     builder.load_relationships(relationships_file)
     
     # Find and merge duplicates
-    duplicates = builder.find_duplicate_entities(similarity_threshold=0.85)
+    duplicates = builder.find_duplicate_entities(
+        similarity_threshold=0.85, 
+        method=config.DEDUP_METHOD
+    )
     if duplicates:
         print(f"发现 {len(duplicates)} 组重复实体")
         builder.merge_duplicate_entities(duplicates)
     
     # Build graph
     builder.build_graph()
-    builder.save_graph(config.KG_DIR)
+    builder.save_graph(config.KG_DIR, write_graphml=write_graphml)
     
     # Step 5: Community detection
     print("\n" + "="*60)
@@ -112,12 +149,14 @@ def build_knowledge_graph():
     print("="*60)
     
     graph = builder.graph
-    detector = CommunityDetector(graph, client)
+    from src.community_detection import CommunityDetector
+    detector = CommunityDetector(graph, client, igraph=builder.ig)
     
     communities = detector.detect_communities(algorithm=config.COMMUNITY_ALGORITHM)
     processed_communities = detector.process_communities(
         communities,
-        min_size=config.MIN_COMMUNITY_SIZE
+        min_size=config.MIN_COMMUNITY_SIZE,
+        checkpoint_file=config.OUTPUT_DIR / "communities_partial.jsonl"
     )
     
     communities_file = config.KG_DIR / "communities.json"
@@ -129,7 +168,9 @@ def build_knowledge_graph():
     print("="*60)
     print(f"\n输出目录: {config.KG_DIR}")
     print("\n生成的文件:")
-    print(f"  - knowledge_graph.graphml (图谱文件)")
+    print(f"  - nodes.parquet, edges.parquet (图谱文件)")
+    if write_graphml:
+        print(f"  - knowledge_graph.graphml (GraphML 导出)")
     print(f"  - entities_deduplicated.json (实体)")
     print(f"  - relationships_deduplicated.json (关系)")
     print(f"  - communities.json (社区)")
@@ -142,8 +183,12 @@ def build_knowledge_graph():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the RoleRAG-PAIMON knowledge graph")
+    parser.add_argument("--graphml", action="store_true", help="also export knowledge_graph.graphml")
+    args = parser.parse_args()
+    
     try:
-        success = build_knowledge_graph()
+        success = build_knowledge_graph(write_graphml=args.graphml)
         sys.exit(0 if success else 1)
     except Exception as e:
         print(f"\n错误: {e}")
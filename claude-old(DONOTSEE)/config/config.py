@@ -17,23 +17,31 @@ class Config:
     OUTPUT_DIR = ROOT_DIR / "output"
     KG_DIR = OUTPUT_DIR / "knowledge_graph"
     CACHE_DIR = OUTPUT_DIR / "cache"
+    PROMPT_CACHE_DIR = CACHE_DIR / "prompts"
     
     # Gemini API
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
     GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-pro")
+    GEMINI_TRANSPORT = os.getenv("GEMINI_TRANSPORT", "grpc")  # grpc, rest
+    # Extra models to spread KG extraction over, e.g. "gemini-2.5-flash"
+    GEMINI_FALLBACK_MODELS = [m for m in os.getenv("GEMINI_FALLBACK_MODELS", "").split(",") if m]
     
     # Data processing
     AVATAR_FILE = DATA_DIR / "avatar_CHS.json"
     
     # KG construction parameters
     CHUNK_SIZE = 512  # characters per chunk
+    PREPROCESS_PROCESSES = os.cpu_count()  # worker processes for avatar preprocessing (1 runs inline)
     ENTITY_TYPES = ["character", "non-character"]
     
+    # Entity deduplication
+    DEDUP_METHOD = "tfidf"  # tfidf, fuzzy (requires rapidfuzz)
+    
     # Relationship parameters
     MIN_RELATIONSHIP_STRENGTH = 0.3
     
     # Community detection parameters
-    COMMUNITY_ALGORITHM = "louvain"  # louvain, leiden, etc.
+    COMMUNITY_ALGORITHM = "multilevel"  # multilevel (Louvain), leiden, label_propagation, greedy (all igraph)
     MIN_COMMUNITY_SIZE = 2
     
     # Agent parameters
@@ -42,10 +50,13 @@ class Config:
     
     # Memory parameters
     CONVERSATION_HISTORY_LIMIT = 5  # keep last k conversations
+    SEMANTIC_CACHE_THRESHOLD = 0.92  # cosine similarity for reusing a cached sub-query
     
     # LLM generation parameters
     TEMPERATURE = 0.7
     MAX_OUTPUT_TOKENS = 1024
+    LLM_CONCURRENCY = 16  # max concurrent API requests in batch extraction
+    USE_BATCH_API = False  # run relationship extraction as an offline Batch API job
     
     @classmethod
     def ensure_dirs(cls):
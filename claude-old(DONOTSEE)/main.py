@@ -4,11 +4,12 @@ Main application integrating all components
 """
 from typing import Optional
 from pathlib import Path
-import json
-import networkx as nx
+import orjson
 
 from config import config
 from src.gemini_client import GeminiClient
+from src.prompt_cache import PromptCache
+from src.graph_io import load_graph, has_graph
 from src.retrieval_agent import RetrievalAgent
 from src.response_generator import ResponseGenerator
 from src.memory_manager import MemoryManager
@@ -34,27 +35,31 @@ class RoleRAGSystem:
         print("Initializing RoleRAG-PAIMON system...")
         
         # Initialize Gemini client
-        self.client = GeminiClient(api_key, config.GEMINI_MODEL)
+        self.client = GeminiClient(
+            api_key, 
+            config.GEMINI_MODEL, 
+            transport=config.GEMINI_TRANSPORT,
+            memo_cache=PromptCache(config.PROMPT_CACHE_DIR)
+        )
         
         # Load knowledge graph
         print("Loading knowledge graph...")
-        graph_file = kg_dir / "knowledge_graph.graphml"
-        self.graph = nx.read_graphml(graph_file)
+        self.graph = load_graph(kg_dir)
         print(f"Loaded graph with {self.graph.number_of_nodes()} nodes "
               f"and {self.graph.number_of_edges()} edges")
         
         # Load communities
         print("Loading communities...")
         communities_file = kg_dir / "communities.json"
-        with open(communities_file, 'r', encoding='utf-8') as f:
-            self.communities = json.load(f)
+        with open(communities_file, 'rb') as f:
+            self.communities = orjson.loads(f.read())
         print(f"Loaded {len(self.communities)} communities")
         
         # Load entities
         print("Loading entities...")
         entities_file = kg_dir / "entities_deduplicated.json"
-        with open(entities_file, 'r', encoding='utf-8') as f:
-            self.entities = json.load(f)
+        with open(entities_file, 'rb') as f:
+            self.entities = orjson.loads(f.read())
         
         # Initialize components
         print("Initializing components...")
@@ -65,10 +70,15 @@ class RoleRAGSystem:
             self.client
         )
         self.response_generator = ResponseGenerator(self.client)
+        # Pick up memory saved under the old .json name; it is rewritten as JSONL on the next save
+        load_file = memory_file
+        if memory_file and not memory_file.exists() and memory_file.with_suffix(".json").exists():
+            load_file = memory_file.with_suffix(".json")
         self.memory_manager = MemoryManager(
             self.client, 
             history_limit=config.CONVERSATION_HISTORY_LIMIT,
-            cache_file=memory_file
+            cache_file=load_file,
+            semantic_threshold=config.SEMANTIC_CACHE_THRESHOLD
         )
         
         self.memory_file = memory_file
@@ -109,8 +119,8 @@ class RoleRAGSystem:
         retrieved_info = []
         queries_to_retrieve = []
         
-        for sq in subqueries:
-            is_cached, cached_info = self.memory_manager.check_cache(sq.text)
+        cache_results = self.memory_manager.check_caches([sq.text for sq in subqueries])
+        for sq, (is_cached, cached_info) in zip(subqueries, cache_results):
             if is_cached:
                 print(f"从缓存获取: {sq.text}")
                 retrieved_info.extend(cached_info)
@@ -182,6 +192,7 @@ class RoleRAGSystem:
                     continue
                 
                 if user_input.lower() in ['quit', 'exit', '退出']:
+                    print(f"\nLLM 缓存统计: {self.client.memo_stats()}")
                     print("\n再见！")
                     break
                 
@@ -210,8 +221,7 @@ def main():
     config.ensure_dirs()
     
     # Check if knowledge graph exists
-    graph_file = config.KG_DIR / "knowledge_graph.graphml"
-    if not graph_file.exists():
+    if not has_graph(config.KG_DIR):
         print("错误: 知识图谱未构建")
         print("请先运行以下命令构建知识图谱：")
         print("  1. conda activate rolerag")
@@ -223,7 +233,7 @@ def main():
         sys.exit(1)
     
     # Initialize system
-    memory_file = config.CACHE_DIR / "conversation_memory.json"
+    memory_file = config.CACHE_DIR / "conversation_memory.jsonl"
     system = RoleRAGSystem(
         api_key=config.GEMINI_API_KEY,
         kg_dir=config.KG_DIR,
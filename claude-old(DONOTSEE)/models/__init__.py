@@ -2,6 +2,10 @@ from .schema import (
     CharacterEntity,
     NonCharacterEntity,
     Relationship,
+    ExtractedRelationship,
+    RelationshipExtraction,
+    RelationshipRecord,
+    BatchRelationshipExtraction,
     Entity,
     Community,
     Query,
@@ -14,6 +18,10 @@ __all__ = [
     "CharacterEntity",
     "NonCharacterEntity", 
     "Relationship",
+    "ExtractedRelationship",
+    "RelationshipExtraction",
+    "RelationshipRecord",
+    "BatchRelationshipExtraction",
     "Entity",
     "Community",
     "Query",
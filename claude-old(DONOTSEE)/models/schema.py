@@ -1,7 +1,8 @@
 """
 Data models for RoleRAG-PAIMON
 """
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, OrderedDict
+import collections
 from pydantic import BaseModel, Field
 
 
@@ -30,6 +31,30 @@ class Relationship(BaseModel):
     strength: float = Field(ge=0.0, le=1.0)  # Relationship strength [0, 1]
     
 
+class ExtractedRelationship(BaseModel):
+    """Relationship as emitted by the LLM; single-letter keys keep output tokens down"""
+    s: str  # Source entity ID
+    t: str  # Target entity ID
+    d: str  # Description
+    a: Optional[str]  # Attitude (null if not stated)
+    w: float  # Strength
+    
+
+class RelationshipExtraction(BaseModel):
+    """LLM output schema for one chunk"""
+    relationships: List[ExtractedRelationship]
+    
+
+class RelationshipRecord(RelationshipExtraction):
+    """One chunk's relationships within a batched response"""
+    record_id: int
+    
+
+class BatchRelationshipExtraction(BaseModel):
+    """LLM output schema for several chunks packed into one prompt"""
+    records: List[RelationshipRecord]
+    
+
 class Entity(BaseModel):
     """Generic entity wrapper"""
     name: str
@@ -69,7 +94,7 @@ class ConversationTurn(BaseModel):
 class ConversationMemory(BaseModel):
     """Conversation history and cache"""
     turns: List[ConversationTurn] = Field(default_factory=list)
-    cache: Dict[str, Any] = Field(default_factory=dict)
+    cache: OrderedDict[str, Any] = Field(default_factory=collections.OrderedDict)  # Least recently used first
     
     def add_turn(self, turn: ConversationTurn):
         """Add a conversation turn"""
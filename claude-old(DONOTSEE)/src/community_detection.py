@@ -1,20 +1,24 @@
 """
 Community detection and summary generation
 """
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 from pathlib import Path
-import json
+import asyncio
 import networkx as nx
-from collections import defaultdict
-from tqdm import tqdm
+import igraph as ig
+import numpy as np
+import orjson
 
 from .gemini_client import GeminiClient
+from .graph_io import load_graph, has_graph
+from .prompt_cache import PromptCache
+from .prompt_utils import PromptTemplate
 
 
 class CommunityDetector:
     """Detect communities in knowledge graph and generate summaries"""
     
-    COMMUNITY_SUMMARY_PROMPT = """
+    COMMUNITY_SUMMARY_PROMPT = PromptTemplate("""
 你是一个专业的知识图谱分析助手。请为以下社区生成一个简洁的摘要。
 
 社区类型：{community_type}
@@ -31,52 +35,94 @@ class CommunityDetector:
 3. 实体之间的主要关系
 
 直接返回摘要文本，不要包含任何额外说明。
-"""
+""")
     
-    def __init__(self, graph: nx.Graph, gemini_client: GeminiClient):
+    def __init__(
+        self, 
+        graph: nx.Graph, 
+        gemini_client: GeminiClient, 
+        igraph: Optional[ig.Graph] = None
+    ):
+        """
+        Initialize detector
+        
+        Args:
+            graph: Knowledge graph
+            gemini_client: Client for summary generation
+            igraph: igraph mirror of graph with "name" and "weight" attributes;
+                built from graph on first use if not given
+        """
         self.graph = graph
         self.client = gemini_client
+        self.igraph = igraph
         self.communities = []
+        # Node position and character flag arrays for vectorized classification
+        self._node_index = {node: i for i, node in enumerate(graph.nodes)}
+        self._is_character = np.fromiter(
+            (data.get("type") == "character" for _, data in graph.nodes(data=True)),
+            dtype=bool,
+            count=graph.number_of_nodes()
+        )
         
-    def detect_communities(self, algorithm: str = "louvain") -> List[List[str]]:
+    def detect_communities(self, algorithm: str = "multilevel") -> List[List[str]]:
         """
-        Detect communities using specified algorithm
+        Detect communities using igraph's C implementations
         
         Args:
-            algorithm: Community detection algorithm ("louvain", "label_propagation", etc.)
+            algorithm: Community detection algorithm ("multilevel" (Louvain; "louvain" is an alias),
+                "leiden", "label_propagation", or "greedy" for fast greedy modularity)
             
         Returns:
             List of communities (each community is a list of node names)
         """
-        if algorithm == "louvain":
-            # Louvain algorithm for community detection
-            import community as community_louvain
-            partition = community_louvain.best_partition(self.graph)
+        g = self._get_igraph()
+        weights = "weight" if g.ecount() else None
+        if algorithm in ("multilevel", "louvain"):
+            clustering = g.community_multilevel(weights=weights)
+        elif algorithm == "leiden":
+            clustering = g.community_leiden(objective_function="modularity", weights=weights)
         elif algorithm == "label_propagation":
-            # Label propagation algorithm
-            communities_gen = nx.community.label_propagation_communities(self.graph)
-            partition = {}
-            for i, comm in enumerate(communities_gen):
-                for node in comm:
-                    partition[node] = i
+            clustering = g.community_label_propagation(weights=weights)
         else:
             # Default: greedy modularity
-            communities_gen = nx.community.greedy_modularity_communities(self.graph)
-            partition = {}
-            for i, comm in enumerate(communities_gen):
-                for node in comm:
-                    partition[node] = i
-        
-        # Convert partition dict to list of communities
-        community_dict = defaultdict(list)
-        for node, comm_id in partition.items():
-            community_dict[comm_id].append(node)
+            clustering = g.community_fastgreedy(weights=weights).as_clustering()
         
-        communities = list(community_dict.values())
+        communities = self._group_by_membership(g, clustering.membership)
         
         print(f"Detected {len(communities)} communities using {algorithm}")
         return communities
     
+    @staticmethod
+    def _group_by_membership(g: ig.Graph, membership: List[int]) -> List[List[str]]:
+        """
+        Invert a vertex -> community membership vector into per-community name lists
+        
+        Args:
+            g: igraph graph the membership refers to
+            membership: Community id (0..k-1) of each vertex
+            
+        Returns:
+            Communities in id order, members in vertex order
+        """
+        if not membership:
+            return []
+        cids = np.asarray(membership, dtype=np.intp)
+        # Stable sort keeps each community's members in vertex order
+        order = np.argsort(cids, kind="stable")
+        splits = np.cumsum(np.bincount(cids))[:-1]
+        names = np.asarray(g.vs["name"], dtype=object)[order]
+        return [group.tolist() for group in np.split(names, splits)]
+    
+    def _get_igraph(self) -> ig.Graph:
+        """Return the igraph mirror of self.graph, converting once if needed"""
+        if self.igraph is None:
+            g = ig.Graph.from_networkx(self.graph)
+            g.vs["name"] = g.vs["_nx_name"]
+            if g.ecount():
+                g.es["weight"] = [float(s) if s is not None else 0.5 for s in g.es["strength"]]
+            self.igraph = g
+        return self.igraph
+    
     def classify_community(self, community: List[str]) -> str:
         """
         Classify community as character-focused or event-focused
@@ -87,15 +133,11 @@ class CommunityDetector:
         Returns:
             "character-focused" or "event-focused"
         """
-        character_count = 0
-        non_character_count = 0
-        
-        for node in community:
-            node_data = self.graph.nodes[node]
-            if node_data.get("type") == "character":
-                character_count += 1
-            else:
-                non_character_count += 1
+        indices = np.fromiter(
+            (self._node_index[node] for node in community), dtype=np.intp, count=len(community)
+        )
+        character_count = int(self._is_character[indices].sum())
+        non_character_count = len(community) - character_count
         
         # If more than 50% are characters, it's character-focused
         if character_count > non_character_count:
@@ -120,9 +162,20 @@ class CommunityDetector:
         Returns:
             Generated summary text
         """
-        # Gather entity information
+        prompt = self._summary_prompt(community, community_type)
+        
+        try:
+            summary = self.client.generate(prompt, temperature=0.5, max_tokens=500)
+            return summary
+        except Exception as e:
+            print(f"Error generating summary for community {community_id}: {e}")
+            return self._fallback_summary(community)
+    
+    def _summary_prompt(self, community: List[str], community_type: str) -> str:
+        """Build the summary prompt from the community's entities and internal relationships"""
+        # Gather entity information (first 20 entities)
         entities_info = []
-        for node in community:
+        for node in community[:20]:
             node_data = self.graph.nodes[node]
             if node_data.get("type") == "character":
                 info = f"- {node}（角色）: {node_data.get('persona', '')}"
@@ -130,43 +183,50 @@ class CommunityDetector:
                 info = f"- {node}（非角色）: {node_data.get('description', '')}"
             entities_info.append(info)
         
-        # Gather relationship information
+        # Gather relationship information (first 20 edges inside the community)
+        members = set(community)
         relationships_info = []
-        for source, target in self.graph.edges(community):
-            if source in community and target in community:
-                edge_data = self.graph.edges[source, target]
+        # Sources come from community, so only the target needs checking
+        for source, target, edge_data in self.graph.edges(community, data=True):
+            if target in members:
                 desc = edge_data.get("description", "")
-                rel_info = f"- {source} → {target}: {desc}"
-                relationships_info.append(rel_info)
+                relationships_info.append(f"- {source} → {target}: {desc}")
+                if len(relationships_info) == 20:
+                    break
         
         # Prepare prompt
-        entities_str = "\n".join(entities_info[:20])  # Limit to first 20 entities
-        relationships_str = "\n".join(relationships_info[:20])  # Limit to first 20 relationships
+        entities_str = "\n".join(entities_info)
+        relationships_str = "\n".join(relationships_info)
         
-        prompt = self.COMMUNITY_SUMMARY_PROMPT.format(
+        return self.COMMUNITY_SUMMARY_PROMPT.format(
             community_type=community_type,
             entities_info=entities_str,
             relationships_info=relationships_str
         )
-        
-        try:
-            summary = self.client.generate(prompt, temperature=0.5, max_tokens=500)
-            return summary
-        except Exception as e:
-            print(f"Error generating summary for community {community_id}: {e}")
-            return f"社区包含 {len(community)} 个实体。"
+    
+    @staticmethod
+    def _fallback_summary(community: List[str]) -> str:
+        return f"社区包含 {len(community)} 个实体。"
     
     def process_communities(
         self, 
         communities: List[List[str]], 
-        min_size: int = 2
+        min_size: int = 2,
+        concurrency: Optional[int] = None,
+        checkpoint_file: Optional[Path] = None
     ) -> List[Dict[str, Any]]:
         """
         Process all communities: classify and generate summaries
         
+        Summaries are requested concurrently; the client retries each one with
+        exponential backoff (e.g. on rate limits).
+        
         Args:
             communities: List of communities
             min_size: Minimum community size to process
+            concurrency: Maximum summary requests in flight (default: client's max_concurrency)
+            checkpoint_file: If given, each summary is appended here as it completes,
+                and summaries already recorded by an interrupted run are reused
             
         Returns:
             List of community dictionaries with metadata and summaries
@@ -174,31 +234,51 @@ class CommunityDetector:
         print(f"Processing {len(communities)} communities...")
         
         processed_communities = []
-        
-        for i, community in enumerate(tqdm(communities, desc="Generating summaries")):
+        for i, community in enumerate(communities):
             if len(community) < min_size:
                 continue
             
-            community_id = f"community_{i}"
-            community_type = self.classify_community(community)
-            
-            # Generate summary
-            summary = self.generate_community_summary(
-                community_id, 
-                community, 
-                community_type
-            )
-            
-            community_data = {
-                "id": community_id,
+            processed_communities.append({
+                "id": f"community_{i}",
                 "members": community,
                 "size": len(community),
-                "type": community_type,
-                "summary": summary
-            }
-            
-            processed_communities.append(community_data)
-            self.communities = processed_communities
+                "type": self.classify_community(community)
+            })
+        
+        # Prompts embed the members and their relationships, so their hash identifies the summary
+        prompts = [self._summary_prompt(c["members"], c["type"]) for c in processed_communities]
+        prompt_ids = {prompt: PromptCache.make_key(prompt) for prompt in prompts}
+        done = self._load_checkpoint(checkpoint_file) if checkpoint_file else {}
+        pending = [prompt for prompt in dict.fromkeys(prompts) if prompt_ids[prompt] not in done]
+        if done:
+            print(f"Resuming: {len(prompt_ids) - len(pending)} summaries already generated")
+        
+        checkpoint = open(checkpoint_file, 'ab') if checkpoint_file else None
+        
+        def record(prompt: str, summary: str):
+            done[prompt_ids[prompt]] = summary
+            if checkpoint:
+                checkpoint.write(orjson.dumps({"id": prompt_ids[prompt], "summary": summary}) + b"\n")
+                checkpoint.flush()
+        
+        # Generate summaries
+        try:
+            results = asyncio.run(self.client.generate_batch(
+                pending, temperature=0.5, max_tokens=500,
+                concurrency=concurrency, desc="Generating summaries", on_result=record
+            ))
+        finally:
+            if checkpoint:
+                checkpoint.close()
+        errors = {prompt: result for prompt, result in zip(pending, results) if isinstance(result, Exception)}
+        
+        for community_data, prompt in zip(processed_communities, prompts):
+            summary = done.get(prompt_ids[prompt])
+            if summary is None:
+                print(f"Error generating summary for community {community_data['id']}: {errors.get(prompt)}")
+                summary = self._fallback_summary(community_data["members"])
+            community_data["summary"] = summary
+        self.communities = processed_communities
         
         print(f"Processed {len(processed_communities)} communities (min_size={min_size})")
         
@@ -209,10 +289,26 @@ class CommunityDetector:
         
         return processed_communities
     
+    @staticmethod
+    def _load_checkpoint(checkpoint_file: Path) -> Dict[str, str]:
+        """Load {prompt id: summary} recorded by an earlier, interrupted run"""
+        done = {}
+        if not checkpoint_file.exists():
+            return done
+        with open(checkpoint_file, 'rb') as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # Truncated last line from an interrupted write
+                    continue
+                done[record["id"]] = record["summary"]
+        return done
+    
     def save_communities(self, output_file: Path):
         """Save communities to file"""
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(self.communities, f, ensure_ascii=False, indent=2)
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(self.communities, option=orjson.OPT_INDENT_2))
         
         print(f"Saved {len(self.communities)} communities to {output_file}")
 
@@ -227,13 +323,12 @@ if __name__ == "__main__":
         sys.exit(1)
     
     # Load graph
-    graph_file = config.KG_DIR / "knowledge_graph.graphml"
-    if not graph_file.exists():
-        print(f"Error: {graph_file} not found. Run kg_builder.py first.")
+    if not has_graph(config.KG_DIR):
+        print(f"Error: no knowledge graph found in {config.KG_DIR}. Run kg_builder.py first.")
         sys.exit(1)
     
     print("Loading knowledge graph...")
-    graph = nx.read_graphml(graph_file)
+    graph = load_graph(config.KG_DIR)
     print(f"Loaded graph with {graph.number_of_nodes()} nodes and {graph.number_of_edges()} edges")
     
     # Initialize detector
@@ -246,7 +341,8 @@ if __name__ == "__main__":
     # Process and generate summaries
     processed_communities = detector.process_communities(
         communities, 
-        min_size=config.MIN_COMMUNITY_SIZE
+        min_size=config.MIN_COMMUNITY_SIZE,
+        checkpoint_file=config.OUTPUT_DIR / "communities_partial.jsonl"
     )
     
     # Save results
@@ -1,14 +1,26 @@
 """
 Data preprocessing for avatar data
 """
-import json
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Iterator, Optional, Tuple
 from pathlib import Path
+from functools import partial
+from itertools import chain, islice
+from multiprocessing import Pool
+import re
+import ijson
+import numpy as np
+import orjson
 
 
 class DataPreprocessor:
     """Preprocess avatar data from JSON"""
     
+    # A sentence runs up to and including a terminator, or up to a line break
+    _SENTENCE_RE = re.compile(r"[^。！？；…\n]*[。！？；…]|[^。！？；…\n]+")
+    
+    # Below this many avatars, worker startup costs more than it saves
+    PARALLEL_MIN_AVATARS = 64
+    
     def __init__(self, data_file: Path):
         self.data_file = data_file
         self.raw_data = None
@@ -16,10 +28,15 @@ class DataPreprocessor:
         
     def load_data(self) -> Dict[str, Any]:
         """Load raw avatar data"""
-        with open(self.data_file, 'r', encoding='utf-8') as f:
-            self.raw_data = json.load(f)
+        with open(self.data_file, 'rb') as f:
+            self.raw_data = orjson.loads(f.read())
         return self.raw_data
     
+    def iter_avatars(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Stream (avatar name, avatar data) pairs without loading the whole file"""
+        with open(self.data_file, 'rb') as f:
+            yield from ijson.kvitems(f, "", use_float=True)
+    
     def extract_key_fields(self, avatar_name: str, avatar_data: Dict[str, Any]) -> Dict[str, Any]:
         """
         Extract key fields for a single avatar
@@ -49,28 +66,10 @@ class DataPreprocessor:
         if not text or len(text) <= chunk_size:
             return [text] if text else []
         
-        chunks = []
-        current_chunk = ""
-        
-        # Split by common sentence endings
-        sentences = text.replace('。', '。\n').replace('！', '！\n').replace('？', '？\n').split('\n')
-        
-        for sentence in sentences:
-            sentence = sentence.strip()
-            if not sentence:
-                continue
-                
-            if len(current_chunk) + len(sentence) <= chunk_size:
-                current_chunk += sentence
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk)
-                current_chunk = sentence
-        
-        if current_chunk:
-            chunks.append(current_chunk)
-            
-        return chunks
+        sentences = [s for s in (m.strip() for m in self._SENTENCE_RE.findall(text)) if s]
+        lengths = np.fromiter((len(s) for s in sentences), dtype=np.int64, count=len(sentences))
+        
+        return ["".join(sentences[start:end]) for start, end in _pack_sentences(lengths, chunk_size)]
     
     def create_text_chunks(self, avatar_data: Dict[str, Any], chunk_size: int = 512) -> List[Dict[str, Any]]:
         """
@@ -81,75 +80,135 @@ class DataPreprocessor:
         chunks = []
         
         # Combine basic info
-        basic_info = f"{avatar_data['name']}，{avatar_data['avatarTitle']}。{avatar_data['desc']}"
+        parts = [f"{avatar_data['name']}，{avatar_data['avatarTitle']}。{avatar_data['desc']}"]
         if avatar_data['avatarNative']:
-            basic_info += f"来自{avatar_data['avatarNative']}。"
+            parts.append(f"来自{avatar_data['avatarNative']}。")
         if avatar_data['infoBirthMonth'] and avatar_data['infoBirthDay']:
-            basic_info += f"生日：{avatar_data['infoBirthMonth']}月{avatar_data['infoBirthDay']}日。"
+            parts.append(f"生日：{avatar_data['infoBirthMonth']}月{avatar_data['infoBirthDay']}日。")
         
         chunks.append({
             "avatar": avatar_data['name'],
             "type": "basic_info",
-            "text": basic_info
+            "text": "".join(parts)
         })
         
         # Process sayings
         if avatar_data['sayings']:
             sayings_text = "\n".join(avatar_data['sayings'])
-            saying_chunks = self.chunk_text(sayings_text, chunk_size)
-            for i, chunk in enumerate(saying_chunks):
-                chunks.append({
-                    "avatar": avatar_data['name'],
-                    "type": "sayings",
-                    "chunk_id": i,
-                    "text": chunk
-                })
+            chunks.extend(
+                {"avatar": avatar_data['name'], "type": "sayings", "chunk_id": i, "text": chunk}
+                for i, chunk in enumerate(self.chunk_text(sayings_text, chunk_size))
+            )
         
         # Process story
         if avatar_data['story']:
             story_text = "\n".join(avatar_data['story'])
-            story_chunks = self.chunk_text(story_text, chunk_size)
-            for i, chunk in enumerate(story_chunks):
-                chunks.append({
-                    "avatar": avatar_data['name'],
-                    "type": "story",
-                    "chunk_id": i,
-                    "text": chunk
-                })
+            chunks.extend(
+                {"avatar": avatar_data['name'], "type": "story", "chunk_id": i, "text": chunk}
+                for i, chunk in enumerate(self.chunk_text(story_text, chunk_size))
+            )
         
         return chunks
     
-    def process_all(self, chunk_size: int = 512) -> List[Dict[str, Any]]:
+    def process_all(self, chunk_size: int = 512, processes: Optional[int] = None) -> List[Dict[str, Any]]:
         """
         Process all avatars
         
+        Avatars are independent, so with processes > 1 and at least
+        PARALLEL_MIN_AVATARS of them they are processed across a pool of
+        worker processes; otherwise (the default) they run inline. Callers
+        that use the pool on spawn platforms need an `if __name__ == "__main__"`
+        guard. Output order follows the input file.
+        
         Returns list of all text chunks with metadata
         """
-        if self.raw_data is None:
-            self.load_data()
+        # Reuse the data if load_data() was already called, otherwise stream one avatar at a time
+        avatars = self.raw_data.items() if self.raw_data is not None else self.iter_avatars()
+        process_one = partial(_process_avatar, self.data_file, chunk_size)
         
         all_chunks = []
         
-        for avatar_name, avatar_data in self.raw_data.items():
-            # Extract key fields
-            extracted = self.extract_key_fields(avatar_name, avatar_data)
-            self.processed_data.append(extracted)
-            
-            # Create text chunks
-            chunks = self.create_text_chunks(extracted, chunk_size)
-            all_chunks.extend(chunks)
+        # Peek far enough into the (possibly streaming) avatars to know if a pool pays off
+        avatars = iter(avatars)
+        head = list(islice(avatars, self.PARALLEL_MIN_AVATARS))
+        avatars = chain(head, avatars)
+        
+        if not processes or processes == 1 or len(head) < self.PARALLEL_MIN_AVATARS:
+            self._collect(map(process_one, avatars), all_chunks)
+        else:
+            with Pool(processes) as pool:
+                self._collect(pool.imap(process_one, avatars, chunksize=16), all_chunks)
         
         return all_chunks
     
+    def _collect(
+        self, 
+        results: Iterator[Tuple[Dict[str, Any], List[Dict[str, Any]]]], 
+        all_chunks: List[Dict[str, Any]]
+    ):
+        """Accumulate (extracted fields, chunks) results in order"""
+        for extracted, chunks in results:
+            self.processed_data.append(extracted)
+            all_chunks.extend(chunks)
+    
     def save_processed_data(self, output_file: Path):
         """Save processed data"""
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(self.processed_data, f, ensure_ascii=False, indent=2)
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(self.processed_data, option=orjson.OPT_INDENT_2))
     
     def save_chunks(self, chunks: List[Dict[str, Any]], output_file: Path):
         """Save chunks"""
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(chunks, f, ensure_ascii=False, indent=2)
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(chunks, option=orjson.OPT_INDENT_2))
+
+
+def _process_avatar(
+    data_file: Path, 
+    chunk_size: int, 
+    item: Tuple[str, Dict[str, Any]]
+) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """
+    Extract key fields and text chunks for one avatar (runs in a worker process)
+    
+    Args:
+        data_file: Source data file of the calling preprocessor
+        chunk_size: Approximate chunk size in characters
+        item: (avatar name, avatar data)
+        
+    Returns:
+        (extracted fields, text chunks)
+    """
+    # A fresh instance, so the worker doesn't receive the caller's loaded data
+    preprocessor = DataPreprocessor(data_file)
+    avatar_name, avatar_data = item
+    extracted = preprocessor.extract_key_fields(avatar_name, avatar_data)
+    return extracted, preprocessor.create_text_chunks(extracted, chunk_size)
+
+
+def _pack_sentences(lengths: np.ndarray, chunk_size: int) -> List[Tuple[int, int]]:
+    """
+    Greedily pack consecutive sentences into chunks of at most chunk_size characters
+    
+    A sentence longer than chunk_size becomes a chunk of its own.
+    
+    Args:
+        lengths: Length of each sentence
+        chunk_size: Maximum characters per chunk
+        
+    Returns:
+        (start, end) sentence index ranges, one per chunk
+    """
+    ends = np.cumsum(lengths)
+    bounds = []
+    start = 0
+    base = 0
+    # One binary search per chunk instead of a Python step per sentence
+    while start < len(ends):
+        end = max(int(np.searchsorted(ends, base + chunk_size, side="right")), start + 1)
+        bounds.append((start, end))
+        base = int(ends[end - 1])
+        start = end
+    return bounds
 
 
 if __name__ == "__main__":
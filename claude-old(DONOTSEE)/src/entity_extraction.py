@@ -1,24 +1,24 @@
 """
 Entity extraction from text chunks using Gemini API
 """
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from pathlib import Path
+import asyncio
 import json
-from tqdm import tqdm
+import orjson
 
 from .gemini_client import GeminiClient
+from .prompt_cache import PromptCache
+from .prompt_utils import PromptTemplate
 from models.schema import CharacterEntity, NonCharacterEntity
 
 
 class EntityExtractor:
     """Extract entities from text chunks using LLM"""
     
-    # Prompt templates
-    CHARACTER_EXTRACTION_PROMPT = """
-你是一个专业的信息提取助手。请从以下文本中提取角色实体信息。
-
-文本：
-{text}
+    # Stable instructions, sent once as cached content
+    CHARACTER_EXTRACTION_INSTRUCTIONS = """
+你是一个专业的信息提取助手。请从用户提供的文本中提取角色实体信息。
 
 请提取文本中出现的所有角色（character），对于每个角色，提取以下信息：
 1. name: 角色名字
@@ -28,24 +28,21 @@ class EntityExtractor:
 5. style_exemplars: 角色的口癖或代表性语句（列表，选择3-5个最有代表性的短语）
 
 返回JSON格式：
-{{
+{
   "characters": [
-    {{
+    {
       "name": "角色名",
       "type": "character",
       "persona": "角色简介",
       "style_description": "说话风格描述",
       "style_exemplars": ["代表性语句1", "代表性语句2", ...]
-    }}
+    }
   ]
-}}
+}
 """
 
-    NON_CHARACTER_EXTRACTION_PROMPT = """
-你是一个专业的信息提取助手。请从以下文本中提取非角色实体信息。
-
-文本：
-{text}
+    NON_CHARACTER_EXTRACTION_INSTRUCTIONS = """
+你是一个专业的信息提取助手。请从用户提供的文本中提取非角色实体信息。
 
 请提取文本中出现的所有非角色实体（non-character），包括：
 - 地点/场所
@@ -60,17 +57,21 @@ class EntityExtractor:
 3. description: 实体的描述
 
 返回JSON格式：
-{{
+{
   "non_characters": [
-    {{
+    {
       "name": "实体名",
       "type": "non-character",
       "description": "实体描述"
-    }}
+    }
   ]
-}}
+}
 """
     
+    # Per-chunk prompt
+    CHUNK_PROMPT = PromptTemplate("""文本：
+{text}""")
+    
     def __init__(self, gemini_client: GeminiClient):
         self.client = gemini_client
         self.entities = {
@@ -92,27 +93,32 @@ class EntityExtractor:
         if not text:
             return []
         
-        prompt = self.CHARACTER_EXTRACTION_PROMPT.format(text=text)
+        prompt = self.CHUNK_PROMPT.format(text=text)
         
         try:
-            result = self.client.generate_json(prompt, temperature=0.3)
-            characters = result.get("characters", [])
-            
-            entities = []
-            for char_data in characters:
-                try:
-                    entity = CharacterEntity(**char_data)
-                    entities.append(entity)
-                except Exception as e:
-                    print(f"Error creating CharacterEntity: {e}")
-                    print(f"Data: {char_data}")
-            
-            return entities
+            result = self.client.generate_json(
+                prompt, temperature=0.3, 
+                system_instruction=self.CHARACTER_EXTRACTION_INSTRUCTIONS
+            )
+            return self._parse_characters(result)
             
         except Exception as e:
             print(f"Error extracting characters from chunk: {e}")
             return []
     
+    def _parse_characters(self, result: Dict[str, Any]) -> List[CharacterEntity]:
+        """Convert an extraction response into CharacterEntity objects"""
+        entities = []
+        for char_data in result.get("characters", []):
+            try:
+                entity = CharacterEntity(**char_data)
+                entities.append(entity)
+            except Exception as e:
+                print(f"Error creating CharacterEntity: {e}")
+                print(f"Data: {char_data}")
+        
+        return entities
+    
     def extract_non_characters_from_chunk(self, chunk: Dict[str, Any]) -> List[NonCharacterEntity]:
         """
         Extract non-character entities from a text chunk
@@ -127,61 +133,88 @@ class EntityExtractor:
         if not text:
             return []
         
-        prompt = self.NON_CHARACTER_EXTRACTION_PROMPT.format(text=text)
+        prompt = self.CHUNK_PROMPT.format(text=text)
         
         try:
-            result = self.client.generate_json(prompt, temperature=0.3)
-            non_characters = result.get("non_characters", [])
-            
-            entities = []
-            for nc_data in non_characters:
-                try:
-                    entity = NonCharacterEntity(**nc_data)
-                    entities.append(entity)
-                except Exception as e:
-                    print(f"Error creating NonCharacterEntity: {e}")
-                    print(f"Data: {nc_data}")
-            
-            return entities
+            result = self.client.generate_json(
+                prompt, temperature=0.3, 
+                system_instruction=self.NON_CHARACTER_EXTRACTION_INSTRUCTIONS
+            )
+            return self._parse_non_characters(result)
             
         except Exception as e:
             print(f"Error extracting non-characters from chunk: {e}")
             return []
     
+    def _parse_non_characters(self, result: Dict[str, Any]) -> List[NonCharacterEntity]:
+        """Convert an extraction response into NonCharacterEntity objects"""
+        entities = []
+        for nc_data in result.get("non_characters", []):
+            try:
+                entity = NonCharacterEntity(**nc_data)
+                entities.append(entity)
+            except Exception as e:
+                print(f"Error creating NonCharacterEntity: {e}")
+                print(f"Data: {nc_data}")
+        
+        return entities
+    
     def process_chunks(
         self, 
         chunks: List[Dict[str, Any]], 
         extract_characters: bool = True,
-        extract_non_characters: bool = True
+        extract_non_characters: bool = True,
+        concurrency: Optional[int] = None
     ) -> Dict[str, Any]:
         """
         Process all chunks and extract entities
         
+        All chunks are sent to the API concurrently; results are merged in
+        chunk order so the outcome matches sequential processing.
+        
         Args:
             chunks: List of text chunks
             extract_characters: Whether to extract characters
             extract_non_characters: Whether to extract non-characters
+            concurrency: Maximum requests in flight (default: client setting)
             
         Returns:
             Dictionary with extracted entities
         """
         print(f"Processing {len(chunks)} chunks...")
         
-        for chunk in tqdm(chunks, desc="Extracting entities"):
-            # Extract characters
-            if extract_characters:
-                characters = self.extract_characters_from_chunk(chunk)
-                for char in characters:
+        texts = [chunk.get("text", "") for chunk in chunks]
+        texts = [text for text in texts if text]
+        prompts = [self.CHUNK_PROMPT.format(text=text) for text in texts]
+        
+        # Extract characters
+        if extract_characters:
+            results = asyncio.run(self.client.generate_json_batch(
+                prompts, temperature=0.3, concurrency=concurrency, desc="Extracting characters",
+                system_instruction=self.CHARACTER_EXTRACTION_INSTRUCTIONS
+            ))
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"Error extracting characters from chunk: {result}")
+                    continue
+                for char in self._parse_characters(result):
                     # Merge if entity already exists
                     if char.name in self.entities["characters"]:
                         self._merge_character(char)
                     else:
                         self.entities["characters"][char.name] = char
-            
-            # Extract non-characters
-            if extract_non_characters:
-                non_chars = self.extract_non_characters_from_chunk(chunk)
-                for nc in non_chars:
+        
+        # Extract non-characters
+        if extract_non_characters:
+            results = asyncio.run(self.client.generate_json_batch(
+                prompts, temperature=0.3, concurrency=concurrency, desc="Extracting non-characters",
+                system_instruction=self.NON_CHARACTER_EXTRACTION_INSTRUCTIONS
+            ))
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"Error extracting non-characters from chunk: {result}")
+                    continue
+                for nc in self._parse_non_characters(result):
                     # Merge if entity already exists
                     if nc.name in self.entities["non_characters"]:
                         self._merge_non_character(nc)
@@ -202,10 +235,10 @@ class EntityExtractor:
         if len(new_char.style_description) > len(existing.style_description):
             existing.style_description = new_char.style_description
         
-        # Merge style_exemplars (avoid duplicates)
-        for exemplar in new_char.style_exemplars:
-            if exemplar not in existing.style_exemplars:
-                existing.style_exemplars.append(exemplar)
+        # Merge style_exemplars (avoid duplicates, keep order)
+        existing.style_exemplars = list(
+            dict.fromkeys(existing.style_exemplars + new_char.style_exemplars)
+        )
     
     def _merge_non_character(self, new_nc: NonCharacterEntity):
         """Merge new non-character info with existing"""
@@ -222,8 +255,8 @@ class EntityExtractor:
             "non_characters": [nc.model_dump() for nc in self.entities["non_characters"].values()]
         }
         
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, ensure_ascii=False, indent=2)
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(output_data, option=orjson.OPT_INDENT_2))
         
         print(f"Saved {len(output_data['characters'])} characters and "
               f"{len(output_data['non_characters'])} non-characters to {output_file}")
@@ -248,7 +281,13 @@ if __name__ == "__main__":
         chunks = json.load(f)
     
     # Extract entities
-    client = GeminiClient(config.GEMINI_API_KEY, config.GEMINI_MODEL)
+    client = GeminiClient(
+        config.GEMINI_API_KEY, 
+        config.GEMINI_MODEL, 
+        config.LLM_CONCURRENCY,
+        cache=PromptCache(config.PROMPT_CACHE_DIR),
+        transport=config.GEMINI_TRANSPORT
+    )
     extractor = EntityExtractor(client)
     
     entities = extractor.process_chunks(chunks)
@@ -2,32 +2,111 @@
 Gemini API client wrapper
 """
 import google.generativeai as genai
-from typing import List, Dict, Any, Optional
-import json
+from google.api_core import exceptions as google_exceptions
+from typing import List, Dict, Any, Optional, Callable, Union
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from tqdm.asyncio import tqdm as async_tqdm
+import asyncio
+import numpy as np
+import orjson
+import random
+import threading
 import time
 
+from .prompt_cache import PromptCache
+
 
 class GeminiClient:
-    """Wrapper for Gemini API"""
+    """
+    Wrapper for Gemini API
+    
+    Create one client per process and pass it to every component: genai.configure
+    is process-global, and sharing the client reuses its gRPC channel and worker
+    threads. Use it as a context manager (or call close) to release the threads.
+    """
+    
+    BATCH_DONE_STATES = {
+        "JOB_STATE_SUCCEEDED", 
+        "JOB_STATE_PARTIALLY_SUCCEEDED",
+        "JOB_STATE_FAILED", 
+        "JOB_STATE_CANCELLED", 
+        "JOB_STATE_EXPIRED"
+    }
     
-    def __init__(self, api_key: str, model_name: str = "gemini-pro"):
+    EMBEDDING_MODEL = "models/text-embedding-004"
+    
+    def __init__(
+        self, 
+        api_key: str, 
+        model_name: str = "gemini-pro", 
+        max_concurrency: int = 16,
+        cache: Optional[PromptCache] = None,
+        base_backoff: float = 0.1,
+        max_backoff: float = 8.0,
+        json_mode: Optional[bool] = None,
+        transport: str = "grpc",
+        memo_size: int = 1024,
+        memo_cache: Optional[PromptCache] = None
+    ):
         """
         Initialize Gemini client
         
         Args:
             api_key: Gemini API key
             model_name: Model name (default: gemini-pro)
+            max_concurrency: Maximum number of requests in flight for async/batch calls
+            cache: Optional persistent response cache; repeated prompts skip the API
+            base_backoff: Base retry delay in seconds, doubled per attempt
+            max_backoff: Upper bound on a single retry delay in seconds
+            json_mode: Request application/json output in generate_json; by default
+                enabled for all models except the 1.0 generation, which lacks it
+            transport: SDK transport ("grpc" or "rest"); gRPC multiplexes all
+                requests from the worker threads over one persistent HTTP/2 channel
+            memo_size: Number of parsed generate_json responses kept in an in-memory
+                LRU, so identical structured requests in a session are sent once (0 disables)
+            memo_cache: Optional on-disk backing for the memo, so these responses
+                survive restarts
         """
-        genai.configure(api_key=api_key)
+        genai.configure(api_key=api_key, transport=transport)
+        self.api_key = api_key
+        self.model_name = model_name
         self.model = genai.GenerativeModel(model_name)
+        self.cache = cache
         self.chat = None
+        self.max_concurrency = max_concurrency
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        if json_mode is None:
+            json_mode = not model_name.startswith(("gemini-pro", "gemini-1.0"))
+        self.json_mode = json_mode
+        # Worker threads for the async API; created on first async call
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        # system instruction -> model bound to its cached content
+        self._instruction_models: Dict[str, genai.GenerativeModel] = {}
+        # system instruction -> (cached content name, expiry time)
+        self._instruction_caches: Dict[str, tuple] = {}
+        self._instruction_lock = threading.Lock()
+        # In-memory LRU of generate_json responses, most recently used last
+        self.memo_size = memo_size
+        self._memo: "OrderedDict[tuple, str]" = OrderedDict()
+        self._memo_lock = threading.Lock()
+        self.memo_cache = memo_cache
+        self.memo_hits = 0
+        self.memo_misses = 0
         
     def generate(
         self, 
         prompt: str, 
         temperature: float = 0.7,
         max_tokens: Optional[int] = None,
-        retry: int = 3
+        retry: int = 3,
+        system_instruction: Optional[str] = None,
+        response_mime_type: Optional[str] = None,
+        response_schema: Optional[type] = None
     ) -> str:
         """
         Generate response from prompt
@@ -37,28 +116,53 @@ class GeminiClient:
             temperature: Sampling temperature
             max_tokens: Maximum output tokens
             retry: Number of retries on failure
+            system_instruction: Stable instructions shared across calls; sent once
+                as cached content instead of with every prompt
+            response_mime_type: Output MIME type, e.g. "application/json"
+            response_schema: Pydantic model the JSON output must follow
             
         Returns:
             Generated text
         """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(prompt, temperature, max_tokens, system_instruction)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
         generation_config = {
             "temperature": temperature,
         }
         if max_tokens:
             generation_config["max_output_tokens"] = max_tokens
+        if response_mime_type:
+            generation_config["response_mime_type"] = response_mime_type
+        if response_schema:
+            generation_config["response_schema"] = response_schema
             
         for attempt in range(retry):
             try:
-                response = self.model.generate_content(
+                model = self.model
+                if system_instruction:
+                    model = self._get_instruction_model(system_instruction)
+                response = model.generate_content(
                     prompt,
                     generation_config=generation_config
                 )
+                if cache_key is not None:
+                    self.cache.put(cache_key, response.text)
                 return response.text
             except Exception as e:
+                # Cached content expired; recreate it on the next attempt
+                if system_instruction and isinstance(e, google_exceptions.NotFound):
+                    with self._instruction_lock:
+                        self._instruction_models.pop(system_instruction, None)
+                        self._instruction_caches.pop(system_instruction, None)
                 if attempt < retry - 1:
-                    wait_time = 2 ** attempt  # Exponential backoff
+                    wait_time = self._backoff(attempt)
                     print(f"API call failed (attempt {attempt + 1}/{retry}): {e}")
-                    print(f"Retrying in {wait_time} seconds...")
+                    print(f"Retrying in {wait_time:.2f} seconds...")
                     time.sleep(wait_time)
                 else:
                     raise
@@ -70,7 +174,9 @@ class GeminiClient:
         prompt: str, 
         temperature: float = 0.7,
         max_tokens: Optional[int] = None,
-        retry: int = 3
+        retry: int = 3,
+        system_instruction: Optional[str] = None,
+        response_schema: Optional[type] = None
     ) -> Dict[str, Any]:
         """
         Generate JSON response from prompt
@@ -80,28 +186,514 @@ class GeminiClient:
             temperature: Sampling temperature
             max_tokens: Maximum output tokens
             retry: Number of retries on failure
+            system_instruction: Stable instructions shared across calls (see generate)
+            response_schema: Pydantic model the output must follow; only enforced
+                in JSON mode, so the prompt should describe the format as well
             
         Returns:
             Parsed JSON object
         """
-        # Add JSON format instruction
-        json_prompt = f"{prompt}\n\nPlease respond with valid JSON only, no additional text."
+        json_prompt = self._json_prompt(prompt)
+        
+        memo_key = self._memo_key(json_prompt, temperature, max_tokens, system_instruction, response_schema)
+        if memo_key is not None:
+            memoized = self._memo_get(memo_key)
+            if memoized is not None:
+                result = self._parse_json(memoized)
+                if result is not None:
+                    return result
+                self._memo_drop(memo_key)
+        
+        response_text = self.generate(
+            json_prompt, temperature, max_tokens, retry, system_instruction,
+            response_mime_type="application/json" if self.json_mode else None,
+            response_schema=response_schema if self.json_mode else None
+        )
+        result = self._parse_json(response_text)
+        
+        # Don't keep unparseable responses around; retry the API next time
+        if result is None:
+            if self.cache is not None:
+                self.cache.delete(
+                    self._cache_key(json_prompt, temperature, max_tokens, system_instruction)
+                )
+            return {}
+        if memo_key is not None:
+            self._memo_put(memo_key, response_text)
+        return result
+    
+    @staticmethod
+    def _json_prompt(prompt: str) -> str:
+        """Add JSON format instruction"""
+        return f"{prompt}\n\nPlease respond with valid JSON only, no additional text."
+    
+    def _backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter so concurrent retries don't collide"""
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * (2 ** attempt)))
+    
+    def _cache_key(
+        self, 
+        prompt: str, 
+        temperature: float, 
+        max_tokens: Optional[int],
+        system_instruction: Optional[str] = None
+    ) -> str:
+        """Cache key covering everything that determines the response"""
+        return PromptCache.make_key(
+            self.model_name, temperature, max_tokens, system_instruction or "", prompt
+        )
+    
+    def _memo_key(
+        self, 
+        prompt: str, 
+        temperature: float, 
+        max_tokens: Optional[int],
+        system_instruction: Optional[str],
+        response_schema: Optional[type]
+    ) -> Optional[tuple]:
+        """Memo key for a generate_json request, or None if memoization is off"""
+        if not self.memo_size:
+            return None
+        schema = response_schema if self.json_mode else None
+        return (self.model_name, round(temperature, 2), prompt, max_tokens, system_instruction, schema)
+    
+    def _memo_get(self, key: tuple) -> Optional[str]:
+        with self._memo_lock:
+            text = self._memo.get(key)
+            if text is not None:
+                self._memo.move_to_end(key)
+                self.memo_hits += 1
+                return text
+        
+        if self.memo_cache is not None:
+            text = self.memo_cache.get(PromptCache.make_key("memo", *key))
+            if text is not None:
+                self._memo_put(key, text, persist=False)
+                with self._memo_lock:
+                    self.memo_hits += 1
+                return text
+        
+        with self._memo_lock:
+            self.memo_misses += 1
+        return None
+    
+    def _memo_put(self, key: tuple, text: str, persist: bool = True):
+        with self._memo_lock:
+            self._memo[key] = text
+            self._memo.move_to_end(key)
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        if persist and self.memo_cache is not None:
+            self.memo_cache.put(PromptCache.make_key("memo", *key), text)
+    
+    def _memo_drop(self, key: tuple):
+        with self._memo_lock:
+            self._memo.pop(key, None)
+        if self.memo_cache is not None:
+            self.memo_cache.delete(PromptCache.make_key("memo", *key))
+    
+    def memo_stats(self) -> Dict[str, int]:
+        """Hit/miss counts of the generate_json response memo"""
+        with self._memo_lock:
+            return {"hits": self.memo_hits, "misses": self.memo_misses, "size": len(self._memo)}
+    
+    CACHE_TTL = 3600  # seconds
+    
+    def create_cache(self, system_instruction: str, ttl: int = CACHE_TTL) -> str:
+        """
+        Upload stable instructions as Gemini cached content
         
-        response_text = self.generate(json_prompt, temperature, max_tokens, retry)
+        Args:
+            system_instruction: Instructions to cache
+            ttl: Time to live in seconds
+            
+        Returns:
+            Cached content name
+        """
+        cached = genai.caching.CachedContent.create(
+            model=self.model_name,
+            system_instruction=system_instruction,
+            ttl=ttl
+        )
+        return cached.name
+    
+    def _get_instruction_model(self, system_instruction: str) -> genai.GenerativeModel:
+        """Return a model bound to the cached system instruction, creating it once"""
+        with self._instruction_lock:
+            model = self._instruction_models.get(system_instruction)
+            if model is not None:
+                self._refresh_cache(system_instruction)
+                model = self._instruction_models.get(system_instruction)
+            if model is None:
+                try:
+                    cache_name = self.create_cache(system_instruction)
+                    model = genai.GenerativeModel.from_cached_content(cached_content=cache_name)
+                    self._instruction_caches[system_instruction] = (cache_name, time.time() + self.CACHE_TTL)
+                except Exception as e:
+                    # Caching unsupported for this model or prompt too short to cache;
+                    # still send the instruction as a system instruction
+                    print(f"Context caching unavailable, using plain system instruction: {e}")
+                    model = genai.GenerativeModel(
+                        self.model_name, 
+                        system_instruction=system_instruction
+                    )
+                self._instruction_models[system_instruction] = model
+            return model
+    
+    def _refresh_cache(self, system_instruction: str):
+        """Extend the cached content's TTL once less than a tenth of it is left (lock held)"""
+        entry = self._instruction_caches.get(system_instruction)
+        if entry is None:
+            return
+        cache_name, expires_at = entry
+        if time.time() < expires_at - self.CACHE_TTL / 10:
+            return
+        try:
+            genai.caching.CachedContent.get(cache_name).update(ttl=self.CACHE_TTL)
+            self._instruction_caches[system_instruction] = (cache_name, time.time() + self.CACHE_TTL)
+        except Exception as e:
+            # Already expired; recreate it
+            print(f"Could not extend cached content, recreating it: {e}")
+            self._instruction_models.pop(system_instruction, None)
+            self._instruction_caches.pop(system_instruction, None)
+    
+    def _parse_json(self, response_text: str) -> Optional[Dict[str, Any]]:
+        """Extract and parse the JSON payload of a model response (None if invalid)"""
+        # Prose such as "[注] {...}" can open with the wrong bracket, so try the other one too
+        starts = sorted(i for i in (response_text.find("{"), response_text.find("[")) if i >= 0)
+        for start in starts:
+            payload = self._extract_json(response_text, start)
+            if payload is None:
+                continue
+            try:
+                return orjson.loads(payload)
+            except orjson.JSONDecodeError:
+                pass
         
-        # Try to extract JSON from response
         try:
-            # Remove markdown code blocks if present
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0]
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0]
-            
-            return json.loads(response_text.strip())
-        except json.JSONDecodeError as e:
+            return orjson.loads(response_text)
+        except orjson.JSONDecodeError as e:
             print(f"Failed to parse JSON: {e}")
             print(f"Response: {response_text[:500]}")
-            return {}
+            return None
+    
+    @staticmethod
+    def _extract_json(text: str, start: int) -> Optional[str]:
+        """
+        Slice the balanced JSON object/array that opens at text[start]
+        
+        Handles markdown fences and surrounding prose in one pass by tracking
+        brackets outside string literals.
+        
+        Args:
+            text: Raw model output
+            start: Index of the opening "{" or "["
+            
+        Returns:
+            The JSON slice, or None if the brackets don't close or don't match
+        """
+        closers = {"{": "}", "[": "]"}
+        expected = []
+        in_string = False
+        escaped = False
+        for i in range(start, len(text)):
+            ch = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch in closers:
+                expected.append(closers[ch])
+            elif ch == "}" or ch == "]":
+                if not expected or expected.pop() != ch:
+                    return None
+                if not expected:
+                    return text[start:i + 1]
+        
+        return None
+    
+    async def generate_async(
+        self, 
+        prompt: str, 
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+        retry: int = 3,
+        system_instruction: Optional[str] = None
+    ) -> str:
+        """
+        Asynchronous variant of generate
+        
+        The blocking SDK call runs on the client's worker threads, so many
+        requests can be in flight without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_executor(),
+            partial(self.generate, prompt, temperature, max_tokens, retry, system_instruction)
+        )
+    
+    async def generate_json_async(
+        self, 
+        prompt: str, 
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+        retry: int = 3,
+        system_instruction: Optional[str] = None,
+        response_schema: Optional[type] = None
+    ) -> Dict[str, Any]:
+        """Asynchronous variant of generate_json"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._get_executor(),
+            partial(
+                self.generate_json, prompt, temperature, max_tokens, retry, system_instruction,
+                response_schema
+            )
+        )
+    
+    async def generate_batch(
+        self, 
+        prompts: List[str], 
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+        retry: int = 3,
+        concurrency: Optional[int] = None,
+        desc: Optional[str] = None,
+        system_instruction: Optional[str] = None,
+        on_result: Optional[Callable[[str, str], None]] = None
+    ) -> List[Union[str, Exception]]:
+        """
+        Generate responses for many prompts concurrently
+        
+        Args:
+            prompts: Input prompts
+            temperature: Sampling temperature
+            max_tokens: Maximum output tokens
+            retry: Number of retries on failure
+            concurrency: Maximum requests in flight (default: max_concurrency)
+            desc: Progress bar description (no progress bar if None)
+            system_instruction: Instructions shared by all prompts (see generate)
+            on_result: Called with (prompt, response) as each request succeeds
+            
+        Returns:
+            Responses in prompt order; failed requests yield the raised exception
+        """
+        return await self._run_concurrently(
+            self.generate_async, prompts, concurrency, desc, on_result,
+            temperature=temperature, max_tokens=max_tokens, retry=retry,
+            system_instruction=system_instruction
+        )
+    
+    async def generate_json_batch(
+        self, 
+        prompts: List[str], 
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+        retry: int = 3,
+        concurrency: Optional[int] = None,
+        desc: Optional[str] = None,
+        system_instruction: Optional[str] = None,
+        on_result: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+        response_schema: Optional[type] = None
+    ) -> List[Union[Dict[str, Any], Exception]]:
+        """
+        Generate JSON responses for many prompts concurrently
+        
+        Same arguments as generate_batch, plus:
+            on_result: Called with (prompt, result) as each request succeeds
+            response_schema: Pydantic model the output must follow (see generate_json)
+        
+        Returns:
+            Parsed JSON objects in prompt order; failed requests yield the raised exception
+        """
+        return await self._run_concurrently(
+            self.generate_json_async, prompts, concurrency, desc, on_result,
+            temperature=temperature, max_tokens=max_tokens, retry=retry,
+            system_instruction=system_instruction, response_schema=response_schema
+        )
+    
+    async def _run_concurrently(
+        self, 
+        func: Callable, 
+        prompts: List[str], 
+        concurrency: Optional[int],
+        desc: Optional[str],
+        on_result: Optional[Callable[[str, Any], None]],
+        **kwargs
+    ) -> List[Any]:
+        """Run func over prompts with at most `concurrency` calls in flight"""
+        semaphore = asyncio.Semaphore(min(concurrency or self.max_concurrency, self.max_concurrency))
+        
+        async def bounded(prompt: str):
+            async with semaphore:
+                try:
+                    result = await func(prompt, **kwargs)
+                except Exception as e:
+                    return e
+            if on_result:
+                on_result(prompt, result)
+            return result
+        
+        # Identical prompts (e.g. repeated boilerplate chunks) are sent once
+        unique_prompts = list(dict.fromkeys(prompts))
+        tasks = [asyncio.create_task(bounded(prompt)) for prompt in unique_prompts]
+        results = await async_tqdm.gather(*tasks, desc=desc, disable=desc is None)
+        
+        result_by_prompt = dict(zip(unique_prompts, results))
+        return [result_by_prompt[prompt] for prompt in prompts]
+    
+    def generate_json_batch_job(
+        self, 
+        prompts: List[str], 
+        request_file: Path,
+        temperature: float = 0.7,
+        system_instruction: Optional[str] = None,
+        poll_interval: int = 60
+    ) -> List[Union[Dict[str, Any], Exception]]:
+        """
+        Generate JSON responses for many prompts as one offline Gemini Batch API job
+        
+        Batch jobs are billed at half price but may take up to 24h, so this suits
+        offline KG construction. Prompts already in the response cache are not
+        resubmitted, and completed responses are written back to it.
+        
+        Args:
+            prompts: Input prompts
+            request_file: Where to write the JSONL request file for upload
+            temperature: Sampling temperature
+            system_instruction: Instructions shared by all prompts
+            poll_interval: Seconds between job status checks
+            
+        Returns:
+            Parsed JSON objects in prompt order; failed requests yield an exception
+        """
+        # Only needed for batch jobs; the legacy SDK has no Batch API
+        from google import genai as genai_sdk
+        
+        json_prompts = [self._json_prompt(prompt) for prompt in prompts]
+        keys = [
+            self._cache_key(json_prompt, temperature, None, system_instruction) 
+            for json_prompt in json_prompts
+        ]
+        responses = {}
+        if self.cache is not None:
+            for key in keys:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    responses[key] = cached
+        
+        pending = {key: json_prompt for key, json_prompt in zip(keys, json_prompts) if key not in responses}
+        if pending:
+            generation_config = {"temperature": temperature}
+            if self.json_mode:
+                generation_config["response_mime_type"] = "application/json"
+            
+            with open(request_file, 'w', encoding='utf-8') as f:
+                for key, json_prompt in pending.items():
+                    request = {
+                        "contents": [{"role": "user", "parts": [{"text": json_prompt}]}],
+                        "generation_config": generation_config
+                    }
+                    if system_instruction:
+                        request["system_instruction"] = {"parts": [{"text": system_instruction}]}
+                    f.write(orjson.dumps({"key": key, "request": request}).decode("utf-8") + "\n")
+            
+            client = genai_sdk.Client(api_key=self.api_key)
+            uploaded = client.files.upload(
+                file=request_file, 
+                config={"mime_type": "jsonl", "display_name": request_file.name}
+            )
+            job = client.batches.create(
+                model=self.model_name, 
+                src=uploaded.name, 
+                config={"display_name": request_file.stem}
+            )
+            print(f"Submitted batch job {job.name} with {len(pending)} requests")
+            
+            while job.state.name not in self.BATCH_DONE_STATES:
+                time.sleep(poll_interval)
+                job = client.batches.get(name=job.name)
+            
+            if job.state.name not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+                raise RuntimeError(f"Batch job {job.name} ended in {job.state.name}: {job.error}")
+            
+            output = client.files.download(file=job.dest.file_name)
+            for line in output.splitlines():
+                if not line.strip():
+                    continue
+                record = orjson.loads(line)
+                response = record.get("response")
+                if not response or not response.get("candidates"):
+                    continue
+                parts = response["candidates"][0].get("content", {}).get("parts", [])
+                text = "".join(part.get("text", "") for part in parts)
+                responses[record["key"]] = text
+                if self.cache is not None:
+                    self.cache.put(record["key"], text)
+        
+        results = []
+        for key in keys:
+            if key not in responses:
+                results.append(RuntimeError("No response in batch job output"))
+                continue
+            result = self._parse_json(responses[key])
+            if result is None:
+                if self.cache is not None:
+                    self.cache.delete(key)
+                results.append(ValueError("Invalid JSON in batch job response"))
+            else:
+                results.append(result)
+        return results
+    
+    def embed(self, texts: List[str], retry: int = 3) -> np.ndarray:
+        """
+        Embed texts with the Gemini embedding model
+        
+        Args:
+            texts: Texts to embed
+            retry: Number of retries on failure
+            
+        Returns:
+            float32 array with one L2-normalized row per text
+        """
+        for attempt in range(retry):
+            try:
+                result = genai.embed_content(model=self.EMBEDDING_MODEL, content=texts)
+                break
+            except Exception as e:
+                if attempt < retry - 1:
+                    wait_time = self._backoff(attempt)
+                    print(f"Embedding call failed (attempt {attempt + 1}/{retry}): {e}")
+                    print(f"Retrying in {wait_time:.2f} seconds...")
+                    time.sleep(wait_time)
+                else:
+                    raise
+        
+        vectors = np.asarray(result["embedding"], dtype=np.float32).reshape(len(texts), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+    
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+            return self._executor
+    
+    def close(self):
+        """Shut down the async worker threads; the client can't be used afterwards"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+    
+    def __enter__(self) -> "GeminiClient":
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
     
     def start_chat(self, history: Optional[List[Dict[str, str]]] = None):
         """
@@ -143,11 +735,130 @@ class GeminiClient:
                 return response.text
             except Exception as e:
                 if attempt < retry - 1:
-                    wait_time = 2 ** attempt
+                    wait_time = self._backoff(attempt)
                     print(f"Chat API call failed (attempt {attempt + 1}/{retry}): {e}")
-                    print(f"Retrying in {wait_time} seconds...")
+                    print(f"Retrying in {wait_time:.2f} seconds...")
                     time.sleep(wait_time)
                 else:
                     raise
         
         return ""
+
+
+class GeminiClientPool(GeminiClient):
+    """
+    Spread requests over several Gemini models
+    
+    Each request goes to the model with the fewest requests in flight; if it fails
+    (e.g. 429 when that model's quota is exhausted), it fails over to the next one.
+    Has the same interface as GeminiClient, so call sites don't change.
+    
+    Only models are pooled, not API keys: genai.configure is process-global, so
+    every member client uses the same key. Async calls run on the pool's own
+    worker threads; member clients never start theirs.
+    """
+    
+    def __init__(
+        self, 
+        api_key: str, 
+        model_names: List[str],
+        max_concurrency: int = 16,
+        cache: Optional[PromptCache] = None,
+        fallback: bool = True,
+        transport: str = "grpc",
+        memo_size: int = 1024,
+        **client_kwargs
+    ):
+        """
+        Initialize client pool
+        
+        Args:
+            api_key: Gemini API key (the SDK is configured per process, so all
+                endpoints share one key; quotas are per model)
+            model_names: Models to spread requests over; the first is the primary
+            max_concurrency: Maximum requests in flight per model
+            cache: Optional persistent response cache, shared by all models
+            fallback: Retry a failed request on the other models before backing off
+            transport: SDK transport ("grpc" or "rest")
+            memo_size: Size of the pool's in-memory LRU of generate_json responses
+            **client_kwargs: Passed to each GeminiClient
+        """
+        # Responses are memoized once, at the pool level
+        self.clients = [
+            GeminiClient(api_key, model_name, max_concurrency, transport=transport, memo_size=0, **client_kwargs)
+            for model_name in model_names
+        ]
+        super().__init__(
+            api_key, model_names[0], max_concurrency * len(model_names),
+            cache=cache, transport=transport, memo_size=memo_size, **client_kwargs
+        )
+        # Only request JSON output if every model supports it
+        self.json_mode = all(client.json_mode for client in self.clients)
+        self.fallback = fallback
+        self._in_flight = [0] * len(self.clients)
+        self._load_lock = threading.Lock()
+    
+    def generate(
+        self, 
+        prompt: str, 
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+        retry: int = 3,
+        system_instruction: Optional[str] = None,
+        response_mime_type: Optional[str] = None,
+        response_schema: Optional[type] = None
+    ) -> str:
+        """
+        Generate response on the least-loaded model, failing over to the others
+        
+        Same arguments as GeminiClient.generate; a retry round backs off only
+        after every model has failed.
+        """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(prompt, temperature, max_tokens, system_instruction)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        last_error = None
+        for attempt in range(retry):
+            for index in self._endpoint_order():
+                client = self.clients[index]
+                with self._load_lock:
+                    self._in_flight[index] += 1
+                try:
+                    text = client.generate(
+                        prompt, temperature, max_tokens, 1, system_instruction,
+                        response_mime_type, response_schema
+                    )
+                except Exception as e:
+                    last_error = e
+                    print(f"API call on {client.model_name} failed: {e}")
+                    continue
+                finally:
+                    with self._load_lock:
+                        self._in_flight[index] -= 1
+                
+                if cache_key is not None:
+                    self.cache.put(cache_key, text)
+                return text
+            
+            if attempt < retry - 1:
+                wait_time = self._backoff(attempt)
+                print(f"All models failed (attempt {attempt + 1}/{retry}), retrying in {wait_time:.2f} seconds...")
+                time.sleep(wait_time)
+        
+        raise last_error
+    
+    def _endpoint_order(self) -> List[int]:
+        """Model indices to try, least loaded first"""
+        with self._load_lock:
+            order = sorted(range(len(self.clients)), key=self._in_flight.__getitem__)
+        return order if self.fallback else order[:1]
+    
+    def close(self):
+        """Shut down the worker threads of the pool and every model client"""
+        super().close()
+        for client in self.clients:
+            client.close()
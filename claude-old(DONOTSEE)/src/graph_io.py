@@ -0,0 +1,212 @@
+"""
+Knowledge graph persistence
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from pathlib import Path
+import math
+import os
+import pickle
+import xml.etree.ElementTree as ET
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+
+GRAPHML_FILE = "knowledge_graph.graphml"
+NODES_FILE = "nodes.parquet"
+EDGES_FILE = "edges.parquet"
+PICKLE_FILE = "knowledge_graph.pkl"  # Cache of the loaded graph
+
+GRAPHML_NS = "{http://graphml.graphdrawing.org/xmlns}"
+
+
+def save_graph_tables(graph: nx.Graph, output_dir: Path):
+    """
+    Save graph as Parquet node and edge tables
+    
+    Args:
+        graph: Knowledge graph
+        output_dir: Output directory
+    """
+    nodes_df = pd.DataFrame.from_records(
+        [dict(data, name=node) for node, data in graph.nodes(data=True)]
+    )
+    edges_df = pd.DataFrame.from_records(
+        [dict(data, source=source, target=target) for source, target, data in graph.edges(data=True)],
+        columns=["source", "target", "description", "attitude", "strength"]
+    )
+    
+    nodes_df.to_parquet(output_dir / NODES_FILE, compression="zstd", index=False)
+    edges_df.to_parquet(output_dir / EDGES_FILE, compression="zstd", index=False)
+
+
+def has_graph(kg_dir: Path) -> bool:
+    """Whether a saved graph (Parquet tables or GraphML) exists in kg_dir"""
+    tables_exist = (kg_dir / NODES_FILE).exists() and (kg_dir / EDGES_FILE).exists()
+    return tables_exist or (kg_dir / GRAPHML_FILE).exists()
+
+
+def load_graph(kg_dir: Path) -> nx.Graph:
+    """
+    Load knowledge graph, preferring Parquet tables over GraphML
+    
+    The parsed graph is pickled next to its source files and reused until
+    the tables or GraphML are rewritten.
+    
+    Args:
+        kg_dir: Directory containing knowledge graph files
+    
+    Returns:
+        Knowledge graph
+    """
+    nodes_file = kg_dir / NODES_FILE
+    edges_file = kg_dir / EDGES_FILE
+    if nodes_file.exists() and edges_file.exists():
+        sources = [nodes_file, edges_file]
+    else:
+        sources = [kg_dir / GRAPHML_FILE]
+    
+    pickle_file = kg_dir / PICKLE_FILE
+    graph = _load_pickle(pickle_file, sources)
+    if graph is None:
+        graph = _load_tables(nodes_file, edges_file) if len(sources) == 2 else read_graphml(sources[0])
+        _save_pickle(graph, pickle_file)
+    return graph
+
+
+def _load_pickle(pickle_file: Path, sources: List[Path]) -> Optional[nx.Graph]:
+    # Stale once any source file is newer than the cache
+    try:
+        if pickle_file.stat().st_mtime < max(source.stat().st_mtime for source in sources):
+            return None
+        with open(pickle_file, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+
+
+def _save_pickle(graph: nx.Graph, pickle_file: Path):
+    # Write to a temp file first so a concurrent loader never reads a partial pickle
+    tmp_file = pickle_file.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(graph, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, pickle_file)
+    except OSError as e:
+        print(f"Could not cache graph to {pickle_file}: {e}")
+
+
+def _parse_bool(text: str) -> bool:
+    return text.strip().lower() in ("true", "1")
+
+
+_GRAPHML_TYPES: Dict[str, Callable[[str], Any]] = {
+    "boolean": _parse_bool,
+    "int": int,
+    "long": int,
+    "float": float,
+    "double": float,
+    "string": str
+}
+
+
+def read_graphml(graphml_file: Path) -> nx.Graph:
+    """
+    Stream a GraphML file into a graph without building the whole XML tree
+    
+    Covers what nx.write_graphml produces (typed keys with defaults and
+    graph, node and edge data). Each node and edge element is dropped
+    once it has been added, so peak memory stays close to the graph itself.
+    
+    Args:
+        graphml_file: GraphML file
+    
+    Returns:
+        Knowledge graph (DiGraph if the file declares directed edges)
+    """
+    keys: Dict[str, Tuple[str, Callable[[str], Any]]] = {}
+    key_defaults: Dict[str, Dict[str, Any]] = {"node": {}, "edge": {}}
+    graph: Optional[nx.Graph] = None
+    graph_elem = None
+    
+    for event, elem in ET.iterparse(graphml_file, events=("start", "end")):
+        tag = elem.tag
+        if event == "start":
+            if tag == GRAPHML_NS + "graph" and graph is None:
+                graph = nx.DiGraph() if elem.get("edgedefault") == "directed" else nx.Graph()
+                graph.graph["node_default"] = key_defaults["node"]
+                graph.graph["edge_default"] = key_defaults["edge"]
+                graph_elem = elem
+            continue
+        
+        if tag == GRAPHML_NS + "key":
+            name = elem.get("attr.name") or elem.get("id")
+            cast = _GRAPHML_TYPES.get(elem.get("attr.type", "string"), str)
+            keys[elem.get("id")] = (name, cast)
+            default = elem.find(GRAPHML_NS + "default")
+            if default is not None and default.text is not None:
+                # Recorded like nx.read_graphml does, not applied to nodes/edges
+                defaults = key_defaults.get(elem.get("for"))
+                if defaults is not None:
+                    defaults[name] = cast(default.text)
+        elif tag == GRAPHML_NS + "node":
+            graph.add_node(elem.get("id"), **_read_data(elem, keys))
+            graph_elem.remove(elem)
+        elif tag == GRAPHML_NS + "edge":
+            data = _read_data(elem, keys)
+            if elem.get("id") is not None:
+                data["id"] = elem.get("id")
+            graph.add_edge(elem.get("source"), elem.get("target"), **data)
+            graph_elem.remove(elem)
+        elif elem is graph_elem:
+            graph.graph.update(_read_data(elem, keys))
+    
+    if graph is None:
+        raise ValueError(f"No <graph> element in {graphml_file}")
+    return graph
+
+
+def _read_data(elem: ET.Element, keys: Dict[str, Tuple[str, Callable[[str], Any]]]) -> Dict[str, Any]:
+    data = {}
+    for data_elem in elem.findall(GRAPHML_NS + "data"):
+        if data_elem.text is None:
+            continue
+        name, cast = keys[data_elem.get("key")]
+        data[name] = cast(data_elem.text)
+    return data
+
+
+def _load_tables(nodes_file: Path, edges_file: Path) -> nx.Graph:
+    nodes_df = pd.read_parquet(nodes_file)
+    edges_df = pd.read_parquet(edges_file)
+    
+    graph = nx.Graph()
+    # Entities have different fields per type; drop the columns a node doesn't have
+    graph.add_nodes_from(
+        (record["name"], {k: _from_table(v) for k, v in record.items() if not _is_missing(v)})
+        for record in nodes_df.to_dict("records")
+    )
+    graph.add_edges_from(
+        (
+            source,
+            target,
+            {
+                "description": description,
+                "attitude": None if _is_missing(attitude) else attitude,
+                "strength": strength
+            }
+        )
+        for source, target, description, attitude, strength in edges_df.itertuples(index=False)
+    )
+    return graph
+
+
+def _from_table(value: Any) -> Any:
+    # List columns come back from Arrow as numpy arrays
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+def _is_missing(value: Any) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
@@ -1,27 +1,61 @@
 """
 Knowledge graph construction and entity deduplication
 """
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, Tuple, Optional
 from pathlib import Path
+import hashlib
 import json
-import networkx as nx
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from collections import defaultdict
+from itertools import chain
+import joblib
 import numpy as np
+import orjson
+import networkx as nx
+import igraph as ig
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.neighbors import NearestNeighbors
+from scipy.sparse import csr_matrix, vstack
+from scipy.sparse.csgraph import connected_components
+
+from .graph_io import save_graph_tables, GRAPHML_FILE
 
 
 class KnowledgeGraphBuilder:
     """Build and manage knowledge graph with deduplication"""
     
-    def __init__(self):
+    # Names compared per rapidfuzz cdist call in fuzzy deduplication
+    FUZZY_BLOCK_SIZE = 1024
+    
+    def __init__(self, cache_dir: Optional[Path] = None):
+        """
+        Initialize builder
+        
+        Args:
+            cache_dir: Directory for persisting fitted TF-IDF vectors across runs
+        """
         self.graph = nx.Graph()
+        self.ig = None  # igraph mirror of self.graph for fast analytics
         self.entities = {}  # name -> entity data
         self.relationships = []
+        self.cache_dir = cache_dir
+        
+        # Character n-grams (the default word tokenizer finds almost no tokens in
+        # Chinese), hashed so no vocabulary dict has to be built
+        self._hasher = HashingVectorizer(
+            analyzer="char_wb",
+            ngram_range=(2, 4),
+            n_features=2 ** 18,
+            alternate_sign=False,
+            norm=None
+        )
+        # Raw n-gram counts kept across dedup passes so only new texts are hashed
+        self._hashed_counts = None
+        self._hashed_rows = {}  # entity text -> row in _hashed_counts
         
     def load_entities(self, entities_file: Path):
         """Load entities from file"""
-        with open(entities_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(entities_file, 'rb') as f:
+            data = orjson.loads(f.read())
         
         # Process characters
         for char in data.get("characters", []):
@@ -35,17 +69,23 @@ class KnowledgeGraphBuilder:
     
     def load_relationships(self, relationships_file: Path):
         """Load relationships from file"""
-        with open(relationships_file, 'r', encoding='utf-8') as f:
-            self.relationships = json.load(f)
+        with open(relationships_file, 'rb') as f:
+            self.relationships = orjson.loads(f.read())
         
         print(f"Loaded {len(self.relationships)} relationships")
     
-    def find_duplicate_entities(self, similarity_threshold: float = 0.85) -> Dict[str, List[str]]:
+    def find_duplicate_entities(
+        self, 
+        similarity_threshold: float = 0.85,
+        method: str = "tfidf"
+    ) -> Dict[str, List[str]]:
         """
         Find duplicate entities using semantic similarity
         
         Args:
-            similarity_threshold: Cosine similarity threshold for duplicates
+            similarity_threshold: Similarity threshold for duplicates (0-1)
+            method: "tfidf" (cosine over names and descriptions) or "fuzzy"
+                (RapidFuzz string similarity over names, catches alias/spelling variants)
             
         Returns:
             Dictionary mapping canonical name to list of duplicate names
@@ -55,6 +95,26 @@ class KnowledgeGraphBuilder:
         if len(entity_names) < 2:
             return {}
         
+        if method == "tfidf":
+            adjacency = self._tfidf_adjacency(entity_names, similarity_threshold)
+        elif method == "fuzzy":
+            adjacency = self._fuzzy_adjacency(entity_names, similarity_threshold)
+        else:
+            raise ValueError(f"Unknown dedup method: {method}")
+        
+        # Group transitively similar entities (A~B, B~C -> one group);
+        # self-matches on the diagonal don't affect components
+        _, labels = connected_components(adjacency, directed=False)
+        
+        groups = defaultdict(list)
+        for name, label in zip(entity_names, labels):
+            groups[label].append(name)
+        
+        # Use first as canonical
+        return {group[0]: group[1:] for group in groups.values() if len(group) > 1}
+    
+    def _tfidf_adjacency(self, entity_names: List[str], similarity_threshold: float):
+        """Sparse adjacency of entities whose TF-IDF cosine similarity passes the threshold"""
         # Create text representations for each entity
         entity_texts = []
         for name in entity_names:
@@ -65,31 +125,72 @@ class KnowledgeGraphBuilder:
                 text = f"{name} {entity.get('description', '')}"
             entity_texts.append(text)
         
-        # Calculate similarity matrix
-        vectorizer = TfidfVectorizer()
-        tfidf_matrix = vectorizer.fit_transform(entity_texts)
-        similarity_matrix = cosine_similarity(tfidf_matrix)
+        tfidf_matrix = self._fit_tfidf(entity_texts)
         
-        # Find duplicates
-        duplicates = {}
-        processed = set()
+        # Sparse graph of pairs within cosine distance 1 - threshold; avoids the
+        # dense N x N similarity matrix since duplicates are rare
+        neighbors = NearestNeighbors(radius=1 - similarity_threshold, metric="cosine")
+        neighbors.fit(tfidf_matrix)
+        return neighbors.radius_neighbors_graph(mode="connectivity").tocsr()
+    
+    def _fuzzy_adjacency(self, entity_names: List[str], similarity_threshold: float):
+        """Sparse adjacency of entities whose names are fuzzy matches"""
+        from rapidfuzz import process, fuzz
         
-        for i in range(len(entity_names)):
-            if entity_names[i] in processed:
-                continue
-            
-            similar_indices = np.where(similarity_matrix[i] >= similarity_threshold)[0]
-            
-            if len(similar_indices) > 1:
-                # Group similar entities
-                group = [entity_names[j] for j in similar_indices]
-                canonical_name = group[0]  # Use first as canonical
-                duplicates[canonical_name] = group[1:]
-                
-                for name in group:
-                    processed.add(name)
-        
-        return duplicates
+        # cdist returns a dense score array, so compare one block of rows at a time
+        # and keep only the matches to bound memory at block size x N
+        n = len(entity_names)
+        rows, cols = [], []
+        for start in range(0, n, self.FUZZY_BLOCK_SIZE):
+            scores = process.cdist(
+                entity_names[start:start + self.FUZZY_BLOCK_SIZE], 
+                entity_names, 
+                scorer=fuzz.WRatio,
+                score_cutoff=similarity_threshold * 100,
+                workers=-1
+            )
+            block_rows, block_cols = np.nonzero(scores)
+            rows.append(block_rows + start)
+            cols.append(block_cols)
+        
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.intp)
+        cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.intp)
+        return csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(n, n))
+    
+    def _fit_tfidf(self, texts: List[str]):
+        """TF-IDF vectors for texts, reusing the vectors cached for identical inputs"""
+        transformer = TfidfTransformer(sublinear_tf=True, norm="l2")
+        if self.cache_dir is None:
+            return transformer.fit_transform(self._count_ngrams(texts))
+        
+        params = sorted({**self._hasher.get_params(), **transformer.get_params()}.items())
+        key_source = json.dumps([texts, repr(params)], ensure_ascii=False)
+        key = hashlib.blake2b(key_source.encode("utf-8"), digest_size=16).hexdigest()
+        cache_file = self.cache_dir / f"tfidf_{key}.joblib"
+        
+        if cache_file.exists():
+            return joblib.load(cache_file)
+        
+        tfidf_matrix = transformer.fit_transform(self._count_ngrams(texts))
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        joblib.dump(tfidf_matrix, cache_file)
+        return tfidf_matrix
+    
+    def _count_ngrams(self, texts: List[str]):
+        """Raw n-gram count rows for texts, hashing only texts not seen in earlier passes"""
+        new_texts = [text for text in dict.fromkeys(texts) if text not in self._hashed_rows]
+        if new_texts:
+            offset = 0 if self._hashed_counts is None else self._hashed_counts.shape[0]
+            new_counts = self._hasher.transform(new_texts)
+            if self._hashed_counts is None:
+                self._hashed_counts = new_counts
+            else:
+                self._hashed_counts = vstack([self._hashed_counts, new_counts], format="csr")
+            for i, text in enumerate(new_texts):
+                self._hashed_rows[text] = offset + i
+        
+        # IDF is refit over the selected rows, which is cheap compared to hashing
+        return self._hashed_counts[[self._hashed_rows[text] for text in texts]]
     
     def merge_duplicate_entities(self, duplicates: Dict[str, List[str]]):
         """
@@ -104,36 +205,26 @@ class KnowledgeGraphBuilder:
             for dup in dups:
                 duplicate_to_canonical[dup] = canonical
         
-        # Merge entity data
+        # Merge entity data, one pass per group
         for canonical, dups in duplicates.items():
             canonical_entity = self.entities[canonical]
+            group = [canonical_entity] + [self.entities.pop(dup) for dup in dups]
             
-            for dup in dups:
-                dup_entity = self.entities[dup]
-                
-                # Merge based on entity type
-                if canonical_entity["type"] == "character":
-                    # Merge persona (prefer longer)
-                    if len(dup_entity.get("persona", "")) > len(canonical_entity.get("persona", "")):
-                        canonical_entity["persona"] = dup_entity["persona"]
-                    
-                    # Merge style_description
-                    if len(dup_entity.get("style_description", "")) > len(canonical_entity.get("style_description", "")):
-                        canonical_entity["style_description"] = dup_entity["style_description"]
-                    
-                    # Merge style_exemplars
-                    exemplars = canonical_entity.get("style_exemplars", [])
-                    for ex in dup_entity.get("style_exemplars", []):
-                        if ex not in exemplars:
-                            exemplars.append(ex)
-                    canonical_entity["style_exemplars"] = exemplars
-                else:
-                    # Merge description
-                    if len(dup_entity.get("description", "")) > len(canonical_entity.get("description", "")):
-                        canonical_entity["description"] = dup_entity["description"]
-                
-                # Remove duplicate entity
-                del self.entities[dup]
+            # Merge based on entity type: text fields prefer the longest value
+            if canonical_entity["type"] == "character":
+                text_fields = ["persona", "style_description"]
+                # Merge style_exemplars (avoid duplicates, keep order)
+                canonical_entity["style_exemplars"] = list(dict.fromkeys(
+                    chain.from_iterable(e.get("style_exemplars", []) for e in group)
+                ))
+            else:
+                text_fields = ["description"]
+            
+            for field in text_fields:
+                # max keeps the earliest on ties, so the canonical value wins ties
+                longest = max((e.get(field, "") for e in group), key=len)
+                if len(longest) > len(canonical_entity.get(field, "")):
+                    canonical_entity[field] = longest
         
         # Update relationships
         updated_relationships = []
@@ -157,62 +248,99 @@ class KnowledgeGraphBuilder:
     
     def build_graph(self):
         """Build NetworkX graph from entities and relationships"""
-        # Add nodes
-        for name, entity in self.entities.items():
-            self.graph.add_node(name, **entity)
-        
-        # Add edges
-        for rel in self.relationships:
-            self.graph.add_edge(
+        # Add nodes and edges in bulk
+        self.graph.add_nodes_from(self.entities.items())
+        self.graph.add_edges_from(
+            (
                 rel["source"],
                 rel["target"],
-                description=rel.get("description", ""),
-                attitude=rel.get("attitude"),
-                strength=rel.get("strength", 0.5)
+                {
+                    "description": rel.get("description", ""),
+                    "attitude": rel.get("attitude"),
+                    "strength": rel.get("strength", 0.5)
+                }
             )
+            for rel in self.relationships
+        )
+        self.ig = self._build_igraph()
         
         print(f"Built graph with {self.graph.number_of_nodes()} nodes "
               f"and {self.graph.number_of_edges()} edges")
     
+    def _build_igraph(self) -> ig.Graph:
+        """Mirror the NetworkX graph as an igraph graph (C adjacency arrays)"""
+        names = list(self.graph.nodes)
+        index = {name: i for i, name in enumerate(names)}
+        
+        edges = []
+        weights = []
+        for source, target, strength in self.graph.edges(data="strength", default=0.5):
+            edges.append((index[source], index[target]))
+            weights.append(strength)
+        
+        return ig.Graph(
+            n=len(names),
+            edges=edges,
+            directed=False,
+            vertex_attrs={
+                "name": names,
+                "type": [entity_type for _, entity_type in self.graph.nodes(data="type")]
+            },
+            edge_attrs={"weight": weights}
+        )
+    
     def get_graph_statistics(self) -> Dict[str, Any]:
         """Get graph statistics"""
-        character_count = sum(1 for _, data in self.graph.nodes(data=True) 
-                            if data.get("type") == "character")
-        non_character_count = self.graph.number_of_nodes() - character_count
+        if self.ig is None:
+            self.ig = self._build_igraph()
+        
+        node_count = self.ig.vcount()
+        character_count = self.ig.vs["type"].count("character") if node_count else 0
         
         return {
-            "total_nodes": self.graph.number_of_nodes(),
+            "total_nodes": node_count,
             "character_nodes": character_count,
-            "non_character_nodes": non_character_count,
-            "total_edges": self.graph.number_of_edges(),
-            "average_degree": sum(dict(self.graph.degree()).values()) / self.graph.number_of_nodes() if self.graph.number_of_nodes() > 0 else 0,
-            "connected_components": nx.number_connected_components(self.graph)
+            "non_character_nodes": node_count - character_count,
+            "total_edges": self.ig.ecount(),
+            "average_degree": sum(self.ig.degree()) / node_count if node_count > 0 else 0,
+            "connected_components": len(self.ig.connected_components())
         }
     
-    def save_graph(self, output_dir: Path):
-        """Save knowledge graph to files"""
+    def save_graph(self, output_dir: Path, write_graphml: bool = False):
+        """
+        Save knowledge graph to files
+        
+        Args:
+            output_dir: Output directory
+            write_graphml: Also export GraphML for external tools (slow, large)
+        """
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        # Save entities
+        # Save entities, grouped by type in one pass
+        buckets = defaultdict(list)
+        for entity in self.entities.values():
+            buckets[entity["type"]].append(entity)
         entities_output = {
-            "characters": [e for e in self.entities.values() if e["type"] == "character"],
-            "non_characters": [e for e in self.entities.values() if e["type"] == "non-character"]
+            "characters": buckets["character"],
+            "non_characters": buckets["non-character"]
         }
         
-        with open(output_dir / "entities_deduplicated.json", 'w', encoding='utf-8') as f:
-            json.dump(entities_output, f, ensure_ascii=False, indent=2)
+        with open(output_dir / "entities_deduplicated.json", 'wb') as f:
+            f.write(orjson.dumps(entities_output, option=orjson.OPT_INDENT_2))
         
         # Save relationships
-        with open(output_dir / "relationships_deduplicated.json", 'w', encoding='utf-8') as f:
-            json.dump(self.relationships, f, ensure_ascii=False, indent=2)
+        with open(output_dir / "relationships_deduplicated.json", 'wb') as f:
+            f.write(orjson.dumps(self.relationships, option=orjson.OPT_INDENT_2))
         
-        # Save graph as GraphML
-        nx.write_graphml(self.graph, output_dir / "knowledge_graph.graphml")
+        # Save graph as Parquet node/edge tables; GraphML only on request
+        save_graph_tables(self.graph, output_dir)
+        if write_graphml:
+            nx.write_graphml(self.graph, output_dir / GRAPHML_FILE)
         
         # Save statistics
         stats = self.get_graph_statistics()
-        with open(output_dir / "graph_statistics.json", 'w', encoding='utf-8') as f:
-            json.dump(stats, f, ensure_ascii=False, indent=2)
+        with open(output_dir / "graph_statistics.json", 'wb') as f:
+            f.write(orjson.dumps(stats, option=orjson.OPT_INDENT_2))
         
         print(f"Saved knowledge graph to {output_dir}")
         print("Statistics:", stats)
@@ -235,13 +363,16 @@ if __name__ == "__main__":
         sys.exit(1)
     
     # Build knowledge graph
-    builder = KnowledgeGraphBuilder()
+    builder = KnowledgeGraphBuilder(cache_dir=config.CACHE_DIR)
     builder.load_entities(entities_file)
     builder.load_relationships(relationships_file)
     
     # Find and merge duplicates
     print("\nFinding duplicate entities...")
-    duplicates = builder.find_duplicate_entities(similarity_threshold=0.85)
+    duplicates = builder.find_duplicate_entities(
+        similarity_threshold=0.85, 
+        method=config.DEDUP_METHOD
+    )
     print(f"Found {len(duplicates)} groups of duplicates")
     
     if duplicates:
@@ -3,16 +3,20 @@ Conversation memory management for multi-turn dialogue
 """
 from typing import List, Dict, Any, Optional
 from pathlib import Path
-import json
+from concurrent.futures import ThreadPoolExecutor
+import unicodedata
+import numpy as np
+import orjson
 
 from models.schema import ConversationMemory, ConversationTurn
 from .gemini_client import GeminiClient
+from .prompt_utils import PromptTemplate, dumps_truncated
 
 
 class MemoryManager:
     """Manage conversation memory and cache"""
     
-    CALLBACK_DETECTION_PROMPT = """
+    CALLBACK_DETECTION_PROMPT = PromptTemplate("""
 你是一个对话分析助手。请分析用户的新问题是否涉及之前的对话内容。
 
 对话历史摘要：
@@ -28,9 +32,9 @@ class MemoryManager:
   "related_turn_indices": [相关的对话轮次索引，从0开始],
   "reason": "判断理由"
 }}
-"""
+""")
 
-    CACHE_CHECK_PROMPT = """
+    CACHE_CHECK_PROMPT = PromptTemplate("""
 你是一个信息充分性评估助手。请判断缓存中的信息是否足以回答新的子查询。
 
 子查询：{subquery}
@@ -45,18 +49,41 @@ class MemoryManager:
   "is_sufficient": true/false,
   "reason": "判断理由"
 }}
-"""
+""")
     
     def __init__(
         self, 
         gemini_client: GeminiClient,
         history_limit: int = 5,
-        cache_file: Optional[Path] = None
+        cache_file: Optional[Path] = None,
+        semantic_threshold: float = 0.92
     ):
+        """
+        Initialize memory manager
+        
+        Args:
+            gemini_client: Gemini client
+            history_limit: Number of recent turns considered for callbacks and cache checks
+            cache_file: Optional JSONL file to load memory from
+            semantic_threshold: Cosine similarity above which a cached sub-query
+                counts as a paraphrase of a new one
+        """
         self.client = gemini_client
         self.history_limit = history_limit
         self.cache_file = cache_file
+        self.semantic_threshold = semantic_threshold
         self.memory = ConversationMemory()
+        # Normalized embeddings of cached sub-queries, as int8 rows in _cache_keys
+        # order with one float scale per row
+        self._cache_keys: List[str] = []
+        self._cache_codes: Optional[np.ndarray] = None
+        self._cache_scales: Optional[np.ndarray] = None
+        # Cache key -> normalized form, filled lazily
+        self._normalized_keys: Dict[str, str] = {}
+        # Records not yet appended to the memory file
+        self._unsaved: List[Dict[str, Any]] = []
+        # Set when the file on disk isn't JSONL (or was never written) and must be rewritten
+        self._rewrite = True
         
         # Load existing memory if cache file exists
         if cache_file and cache_file.exists():
@@ -109,20 +136,72 @@ class MemoryManager:
         Returns:
             (is_sufficient, cached_info)
         """
+        decided = self._check_cache_locally(subquery)
+        if decided is not None:
+            return decided
+        return self._check_cache_with_llm(subquery, self._recent_context())
+    
+    def check_caches(
+        self, 
+        subqueries: List[str], 
+        max_workers: int = 8
+    ) -> List[tuple[bool, List[Dict[str, Any]]]]:
+        """
+        Check the cache for several sub-queries at once
+        
+        Exact and semantic hits are resolved in order; the remaining LLM
+        sufficiency checks are independent and run concurrently.
+        
+        Args:
+            subqueries: Sub-query texts
+            max_workers: Maximum concurrent LLM checks
+            
+        Returns:
+            (is_sufficient, cached_info) per sub-query, in input order
+        """
+        results = [self._check_cache_locally(subquery) for subquery in subqueries]
+        undecided = [i for i, result in enumerate(results) if result is None]
+        if undecided:
+            cached_info = self._recent_context()
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(undecided))) as executor:
+                checked = executor.map(
+                    lambda i: self._check_cache_with_llm(subqueries[i], cached_info), undecided
+                )
+                for i, result in zip(undecided, checked):
+                    results[i] = result
+        return results
+    
+    def _check_cache_locally(self, subquery: str) -> Optional[tuple[bool, List[Dict[str, Any]]]]:
+        """Cache check result if it can be decided without the LLM, else None"""
         if not self.memory.cache:
             return False, []
         
-        # Get recent cached info
-        recent_turns = self.memory.get_recent_turns(self.history_limit)
-        cached_info = []
-        for turn in recent_turns:
-            cached_info.extend(turn.retrieved_context)
+        # Same or paraphrased sub-query: reuse its context without asking the LLM
+        if subquery in self.memory.cache:
+            return True, [self._touch(subquery)]
+        similar = self._normalized_lookup(subquery) or self._semantic_lookup(subquery)
+        if similar is not None:
+            return True, [self._touch(similar)]
         
-        if not cached_info:
+        if not self._recent_context():
             return False, []
-        
+        return None
+    
+    def _recent_context(self) -> List[Dict[str, Any]]:
+        """Retrieved context of the recent turns"""
+        cached_info = []
+        for turn in self.memory.get_recent_turns(self.history_limit):
+            cached_info.extend(turn.retrieved_context)
+        return cached_info
+    
+    def _check_cache_with_llm(
+        self, 
+        subquery: str, 
+        cached_info: List[Dict[str, Any]]
+    ) -> tuple[bool, List[Dict[str, Any]]]:
+        """Ask the LLM whether the recent context answers subquery"""
         # Format cache for prompt
-        cache_summary = json.dumps(cached_info, ensure_ascii=False)[:1000]  # Limit length
+        cache_summary = dumps_truncated(cached_info, 1000)  # Limit length
         
         prompt = self.CACHE_CHECK_PROMPT.format(
             subquery=subquery,
@@ -142,6 +221,49 @@ class MemoryManager:
             print(f"Error checking cache: {e}")
             return False, []
     
+    def _normalized_lookup(self, subquery: str) -> Optional[str]:
+        """Cache key equal to subquery up to case, width, spacing and punctuation"""
+        target = _normalize_query(subquery)
+        for key in self.memory.cache:
+            normalized = self._normalized_keys.get(key)
+            if normalized is None:
+                normalized = self._normalized_keys[key] = _normalize_query(key)
+            if normalized == target:
+                return key
+        return None
+    
+    def _semantic_lookup(self, subquery: str) -> Optional[str]:
+        """Cache key of the most similar earlier sub-query, if above the threshold"""
+        keys = list(self.memory.cache)
+        try:
+            # LRU reordering doesn't change the key set, so only re-embed on inserts and evictions
+            if self.memory.cache.keys() != set(self._cache_keys):
+                # Embed the changed key set together with the query in one call
+                vectors = self.client.embed(keys + [subquery])
+                self._cache_keys = keys
+                self._cache_codes, self._cache_scales = _quantize(vectors[:-1])
+                query_vector = vectors[-1:]
+            else:
+                query_vector = self.client.embed([subquery])
+        except Exception as e:
+            print(f"Error embedding sub-query: {e}")
+            return None
+        
+        # Integer dot products, rescaled to cosine similarities
+        query_codes, query_scale = _quantize(query_vector)
+        dots = self._cache_codes.astype(np.int32) @ query_codes[0].astype(np.int32)
+        similarities = dots * self._cache_scales * query_scale[0]
+        best = int(similarities.argmax())
+        if similarities[best] < self.semantic_threshold:
+            return None
+        return self._cache_keys[best]
+    
+    def _touch(self, key: str) -> Dict[str, Any]:
+        """Mark a cache entry as most recently used and return it"""
+        self.memory.cache.move_to_end(key)
+        self._unsaved.append({"type": "cache_touch", "key": key})
+        return self.memory.cache[key]
+    
     def add_turn(
         self, 
         query: str, 
@@ -166,6 +288,7 @@ class MemoryManager:
         )
         
         self.memory.add_turn(turn)
+        self._unsaved.append({"type": "turn", **turn.model_dump()})
         
         # Update cache with new retrieved context
         for context in retrieved_context:
@@ -173,6 +296,8 @@ class MemoryManager:
             cache_key = context.get("subquery", "")
             if cache_key:
                 self.memory.cache[cache_key] = context
+                self.memory.cache.move_to_end(cache_key)
+                self._unsaved.append({"type": "cache_update", "key": cache_key, "value": context})
     
     def get_callback_context(self, related_indices: List[int]) -> str:
         """
@@ -204,33 +329,85 @@ class MemoryManager:
         Args:
             max_cache_size: Maximum number of cache entries
         """
-        if len(self.memory.cache) > max_cache_size:
-            # Remove oldest entries (FIFO)
-            cache_items = list(self.memory.cache.items())
-            self.memory.cache = dict(cache_items[-max_cache_size:])
+        # Remove least recently used entries; the cache is kept in LRU order
+        while len(self.memory.cache) > max_cache_size:
+            key, _ = self.memory.cache.popitem(last=False)
+            self._normalized_keys.pop(key, None)
+            self._unsaved.append({"type": "cache_evict", "key": key})
     
-    def save_memory(self, output_file: Path):
-        """Save conversation memory to file"""
-        memory_data = {
-            "turns": [turn.model_dump() for turn in self.memory.turns],
-            "cache": self.memory.cache
-        }
+    def save_memory(self, output_file: Path, compact: bool = False):
+        """
+        Save conversation memory to a JSONL file
+        
+        Only the turns and cache changes since the last save are appended, one
+        record per line. The file is rewritten from the current state when
+        compact is set or when it was loaded from the old single-JSON format.
+        
+        Args:
+            output_file: Memory file
+            compact: Rewrite the file as a snapshot of the current memory
+        """
+        if compact or self._rewrite:
+            records = [{"type": "turn", **turn.model_dump()} for turn in self.memory.turns]
+            records.extend(
+                {"type": "cache_update", "key": key, "value": value}
+                for key, value in self.memory.cache.items()
+            )
+            mode = 'wb'
+        else:
+            records = self._unsaved
+            mode = 'ab'
         
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(memory_data, f, ensure_ascii=False, indent=2)
+        with open(output_file, mode) as f:
+            f.write(b"".join(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE) for record in records))
+        self._unsaved = []
+        self._rewrite = False
     
     def load_memory(self, input_file: Path):
-        """Load conversation memory from file"""
-        with open(input_file, 'r', encoding='utf-8') as f:
-            memory_data = json.load(f)
+        """Load conversation memory from a JSONL file (or the old single-JSON format)"""
+        records = []
+        legacy = torn = False
+        with open(input_file, 'rb') as f:
+            # Stream the log line by line rather than reading it whole
+            for i, line in enumerate(line for line in f if line.strip()):
+                try:
+                    records.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    if i == 0:
+                        legacy = True  # Indented single-JSON file
+                        break
+                    # A torn last line from an interrupted write
+                    print(f"Skipping unreadable memory record in {input_file}")
+                    torn = True
+            legacy = legacy or (bool(records) and "type" not in records[0])
+            
+            if legacy:
+                f.seek(0)
+                data = f.read()
         
-        # Load turns
-        for turn_data in memory_data.get("turns", []):
-            turn = ConversationTurn(**turn_data)
-            self.memory.turns.append(turn)
+        if legacy:
+            memory_data = orjson.loads(data)
+            records = [{"type": "turn", **turn_data} for turn_data in memory_data.get("turns", [])]
+            records.extend(
+                {"type": "cache_update", "key": key, "value": value}
+                for key, value in memory_data.get("cache", {}).items()
+            )
         
-        # Load cache
-        self.memory.cache = memory_data.get("cache", {})
+        # Replay the log
+        for record in records:
+            record_type = record.pop("type")
+            if record_type == "turn":
+                self.memory.turns.append(ConversationTurn(**record))
+            elif record_type == "cache_update":
+                self.memory.cache[record["key"]] = record["value"]
+                self.memory.cache.move_to_end(record["key"])
+            elif record_type == "cache_touch" and record["key"] in self.memory.cache:
+                self.memory.cache.move_to_end(record["key"])
+            elif record_type == "cache_evict":
+                self.memory.cache.pop(record["key"], None)
+        
+        # Appending after a legacy file or a torn line would corrupt it
+        self._rewrite = legacy or torn
     
     def get_recent_context(self, k: int = 3) -> str:
         """
@@ -252,3 +429,20 @@ class MemoryManager:
             context_parts.append(f"问：{turn.query}\n答：{turn.response}")
         
         return "\n\n".join(context_parts)
+
+
+def _normalize_query(text: str) -> str:
+    """Fold width and case and drop whitespace, punctuation and the particle 的"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return "".join(
+        ch for ch in text
+        if ch != "的" and not ch.isspace() and not unicodedata.category(ch).startswith("P")
+    )
+
+
+def _quantize(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row int8 quantization: vectors ~= codes * scales[:, None]"""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
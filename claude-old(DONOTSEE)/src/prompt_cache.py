@@ -0,0 +1,60 @@
+"""
+Persistent on-disk cache for LLM responses
+"""
+from typing import Optional
+from pathlib import Path
+import hashlib
+import json
+import os
+import threading
+
+
+class PromptCache:
+    """Content-addressed response cache stored as sharded JSON files"""
+    
+    def __init__(self, cache_dir: Path):
+        """
+        Initialize prompt cache
+        
+        Args:
+            cache_dir: Directory holding cached responses
+        """
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+    
+    @staticmethod
+    def make_key(*parts: object) -> str:
+        """Build a cache key from everything that determines the response"""
+        raw = "|".join(str(part) for part in parts)
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=20).hexdigest()
+    
+    def _path(self, key: str) -> Path:
+        # Shard by key prefix to keep directories small
+        return self.cache_dir / key[:2] / f"{key}.json"
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for key, or None on a miss"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)["response"]
+        except (FileNotFoundError, KeyError, json.JSONDecodeError):
+            return None
+    
+    def put(self, key: str, value: str):
+        """Store a response under key"""
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        
+        # Write to a temp file first so concurrent readers never see partial data
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"response": value}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    
+    def delete(self, key: str):
+        """Remove a cached response if present"""
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,88 @@
+"""
+Prompt template helpers
+"""
+from typing import Any, List, Optional, Tuple
+import json
+import string
+
+
+class PromptTemplate:
+    """str.format-style prompt template parsed once into literal fragments"""
+    
+    def __init__(self, template: str):
+        """
+        Parse a prompt template
+        
+        Args:
+            template: Template text with plain {name} fields ({{ and }} escape braces)
+        """
+        self.template = template
+        self._pieces: List[Tuple[str, Optional[str]]] = []
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            if field is not None and (not field.isidentifier() or spec or conversion):
+                raise ValueError(f"Unsupported prompt field: {{{field}}}")
+            self._pieces.append((literal, field))
+    
+    def format(self, **values: Any) -> str:
+        """
+        Fill in the template, equivalent to template.format(**values)
+        
+        Args:
+            **values: Value for every field in the template
+        
+        Returns:
+            Prompt text
+        """
+        parts = []
+        for literal, field in self._pieces:
+            parts.append(literal)
+            if field is not None:
+                parts.append(str(values[field]))
+        return "".join(parts)
+    
+    def __str__(self) -> str:
+        return self.template
+
+
+def dumps_truncated(items: List[Any], limit: int, indent: Optional[int] = None) -> str:
+    """
+    Serialize a list for a prompt, cut to limit characters
+    
+    Equivalent to json.dumps(items, ensure_ascii=False, indent=indent)[:limit],
+    but items are serialized one at a time and the rest are skipped once
+    the limit is reached.
+    
+    Args:
+        items: JSON-serializable items
+        limit: Maximum length of the result
+        indent: Indentation as in json.dumps
+    
+    Returns:
+        Truncated JSON text
+    """
+    if not items:
+        return "[]"[:limit]
+    
+    if indent is None:
+        opener, separator, closer = "[", ", ", "]"
+    else:
+        # Items sit one level deep, so every line of an item gains one indent
+        pad = "\n" + " " * indent
+        opener, separator, closer = "[" + pad, "," + pad, "\n]"
+    
+    parts = [opener]
+    size = len(opener)
+    for i, item in enumerate(items):
+        if i:
+            parts.append(separator)
+            size += len(separator)
+        text = json.dumps(item, ensure_ascii=False, indent=indent)
+        if indent is not None:
+            text = text.replace("\n", pad)
+        parts.append(text)
+        size += len(text)
+        if size >= limit:
+            break
+    else:
+        parts.append(closer)
+    return "".join(parts)[:limit]
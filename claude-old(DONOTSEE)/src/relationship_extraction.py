@@ -1,51 +1,82 @@
 """
 Relationship extraction from text chunks using Gemini API
 """
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Callable, Tuple, Union
 from pathlib import Path
+import ahocorasick
+import asyncio
 import json
-from tqdm import tqdm
+import orjson
+import pickle
+from pydantic import TypeAdapter, ValidationError
 
 from .gemini_client import GeminiClient
-from models.schema import Relationship
+from .prompt_cache import PromptCache
+from .prompt_utils import PromptTemplate
+from models.schema import Relationship, RelationshipExtraction, BatchRelationshipExtraction
+
+
+RELATIONSHIP_LIST = TypeAdapter(List[Relationship])
 
 
 class RelationshipExtractor:
     """Extract relationships between entities using LLM"""
     
-    RELATIONSHIP_EXTRACTION_PROMPT = """
-你是一个专业的关系提取助手。请从以下文本中提取实体之间的关系。
+    # Stable instructions, sent once as cached content
+    RELATIONSHIP_EXTRACTION_INSTRUCTIONS = """
+你是一个专业的关系提取助手。请从用户提供的文本中提取已知实体之间的关系。
+已知实体列表每行格式为"编号=名称"，例如"E1=七七"。
 
-文本：
+请识别文本中这些实体之间的关系，对于每个关系，提取以下信息（使用单字母字段名）：
+1. s: 源实体编号（必须在已知实体列表中，如E1）
+2. t: 目标实体编号（必须在已知实体列表中，如E2）
+3. d: 客观的关系描述（事实性的关系）
+4. a: 源实体对目标实体的主观态度或看法（可选，如果文本中没有明确表达态度可为null）
+5. w: 关系强度，0到1之间的浮点数（0.0-0.3为弱关系，0.3-0.7为中等关系，0.7-1.0为强关系）
+
+返回紧凑的JSON，不要使用markdown代码块，不要缩进或换行：
+{"relationships":[{"s":"E1","t":"E2","d":"关系描述","a":"态度描述或null","w":0.8}]}
+"""
+    
+    # Variant for prompts packing several chunks into one request
+    BATCH_EXTRACTION_INSTRUCTIONS = RELATIONSHIP_EXTRACTION_INSTRUCTIONS + """
+用户会一次提供多段文本，每段以"记录 <编号>："开头，段与段之间用分隔线隔开。
+请分别处理每段文本，并按以下JSON格式返回，每段文本对应一项（没有关系时relationships为空列表）：
+{"records":[{"record_id":0,"relationships":[...]}]}
+"""
+    
+    # Short output keys -> Relationship fields
+    OUTPUT_FIELDS = {"s": "source", "t": "target", "d": "description", "a": "attitude", "w": "strength"}
+    
+    # Per-chunk prompt
+    CHUNK_PROMPT = PromptTemplate("""文本：
 {text}
 
 已知实体列表：
+{entities}""")
+    
+    # Multi-chunk prompt; the entity table is sent once per batch
+    BATCH_PROMPT = PromptTemplate("""已知实体列表：
 {entities}
 
-请识别文本中这些实体之间的关系，对于每个关系，提取以下信息：
-1. source: 源实体名称（必须在已知实体列表中）
-2. target: 目标实体名称（必须在已知实体列表中）
-3. description: 客观的关系描述（事实性的关系）
-4. attitude: 源实体对目标实体的主观态度或看法（可选，如果文本中没有明确表达态度可为null）
-5. strength: 关系强度，0到1之间的浮点数（0.0-0.3为弱关系，0.3-0.7为中等关系，0.7-1.0为强关系）
-
-返回JSON格式：
-{{
-  "relationships": [
-    {{
-      "source": "实体A",
-      "target": "实体B",
-      "description": "关系描述",
-      "attitude": "态度描述或null",
-      "strength": 0.8
-    }}
-  ]
-}}
-"""
+{records}""")
+    RECORD_PROMPT = PromptTemplate("""记录 {record_id}：
+{text}""")
+    RECORD_SEPARATOR = "\n---RECORD|||SEP|||BOUNDARY---\n"
     
-    def __init__(self, gemini_client: GeminiClient):
+    def __init__(self, gemini_client: GeminiClient, automaton_file: Optional[Path] = None):
+        """
+        Initialize relationship extractor
+        
+        Args:
+            gemini_client: Gemini client
+            automaton_file: Where to persist the entity-name automaton across runs
+        """
         self.client = gemini_client
+        self.automaton_file = automaton_file
         self.relationships = []
+        self._automaton = None
+        self._automaton_names = None
         
     def extract_relationships_from_chunk(
         self, 
@@ -66,55 +97,94 @@ class RelationshipExtractor:
         if not text or len(entity_names) < 2:
             return []
         
-        # Format entity list
-        entities_str = ", ".join(entity_names)
+        # Only send the entities that occur in this chunk; without two there is no relationship
+        names = self._find_entities(self._get_automaton(entity_names), text)
+        if len(names) < 2:
+            return []
+        entity_table, lookup = self._entity_table(names)
         
-        prompt = self.RELATIONSHIP_EXTRACTION_PROMPT.format(
+        prompt = self.CHUNK_PROMPT.format(
             text=text,
-            entities=entities_str
+            entities=entity_table
         )
         
         try:
-            result = self.client.generate_json(prompt, temperature=0.3)
-            relationships = result.get("relationships", [])
-            
-            rel_objects = []
-            for rel_data in relationships:
-                try:
-                    # Validate that source and target are in entity list
-                    source = rel_data.get("source", "")
-                    target = rel_data.get("target", "")
-                    
-                    if source not in entity_names or target not in entity_names:
-                        continue
-                    
-                    # Handle null attitude
-                    if rel_data.get("attitude") == "null":
-                        rel_data["attitude"] = None
-                    
-                    relationship = Relationship(**rel_data)
-                    rel_objects.append(relationship)
-                except Exception as e:
-                    print(f"Error creating Relationship: {e}")
-                    print(f"Data: {rel_data}")
-            
-            return rel_objects
+            result = self.client.generate_json(
+                prompt, temperature=0.3, 
+                system_instruction=self.RELATIONSHIP_EXTRACTION_INSTRUCTIONS,
+                response_schema=RelationshipExtraction
+            )
+            return self._parse_relationships(result, lookup)
             
         except Exception as e:
             print(f"Error extracting relationships from chunk: {e}")
             return []
     
+    def _parse_relationships(
+        self, 
+        result: Dict[str, Any], 
+        lookup: Dict[str, str]
+    ) -> List[Relationship]:
+        """Convert an extraction response into Relationship objects, mapping entity IDs to names"""
+        cleaned = []
+        for rel_data in result.get("relationships", []):
+            if not isinstance(rel_data, dict):
+                continue
+            # Map the short output keys back to field names
+            rel_data = {self.OUTPUT_FIELDS.get(key, key): value for key, value in rel_data.items()}
+            
+            # Validate that source and target are in the prompt's entity table
+            source = rel_data.get("source")
+            target = rel_data.get("target")
+            if not isinstance(source, str) or not isinstance(target, str):
+                continue
+            rel_data["source"] = lookup.get(source)
+            rel_data["target"] = lookup.get(target)
+            if rel_data["source"] is None or rel_data["target"] is None:
+                continue
+            
+            # Handle null attitude
+            if rel_data.get("attitude") == "null":
+                rel_data["attitude"] = None
+            
+            cleaned.append(rel_data)
+        
+        # Validate the whole list in one pydantic-core call
+        try:
+            return RELATIONSHIP_LIST.validate_python(cleaned)
+        except ValidationError as e:
+            invalid = {error["loc"][0] for error in e.errors()}
+            for index in sorted(invalid):
+                print(f"Error creating Relationship: {cleaned[index]}")
+            return RELATIONSHIP_LIST.validate_python(
+                [rel_data for index, rel_data in enumerate(cleaned) if index not in invalid]
+            )
+    
     def process_chunks(
         self, 
         chunks: List[Dict[str, Any]], 
-        entities: Dict[str, Any]
+        entities: Dict[str, Any],
+        concurrency: Optional[int] = None,
+        batch_file: Optional[Path] = None,
+        checkpoint_file: Optional[Path] = None,
+        batch_size: int = 8
     ) -> List[Relationship]:
         """
         Process all chunks and extract relationships
         
+        Chunks are packed batch_size to a prompt and sent to the API concurrently;
+        results are merged in chunk order so the outcome matches sequential processing.
+        A batch whose response doesn't account for every chunk is retried chunk by chunk.
+        
         Args:
             chunks: List of text chunks
             entities: Dictionary with character and non-character entities
+            concurrency: Maximum requests in flight (default: client setting)
+            batch_file: If given, write the requests here and run them as one
+                offline Gemini Batch API job instead of real-time calls
+            checkpoint_file: If given, each chunk's relationships are appended here
+                as it completes, and chunks already recorded are skipped on rerun
+            batch_size: Chunks per request (1 sends each chunk on its own)
             
         Returns:
             List of Relationship objects
@@ -126,52 +196,259 @@ class RelationshipExtractor:
         
         print(f"Processing {len(chunks)} chunks with {len(entity_names)} entities...")
         
-        for chunk in tqdm(chunks, desc="Extracting relationships"):
-            relationships = self.extract_relationships_from_chunk(chunk, entity_names)
-            self.relationships.extend(relationships)
+        if len(entity_names) < 2:
+            return self.relationships
+        
+        # Each prompt only lists the entities found in its chunk, numbered E1, E2, ...
+        automaton = self._get_automaton(entity_names)
+        entity_order = {name: i for i, name in enumerate(entity_names)}
+        texts = [chunk.get("text", "") for chunk in chunks]
+        texts = [text for text in texts if text]
+        prompts = []
+        text_by_prompt, names_by_prompt, lookups = {}, {}, {}
+        skipped = 0
+        for text in texts:
+            names = self._find_entities(automaton, text)
+            # A chunk mentioning fewer than two known entities can't hold a relationship
+            if len(names) < 2:
+                skipped += 1
+                continue
+            entity_table, lookup = self._entity_table(names)
+            prompt = self.CHUNK_PROMPT.format(text=text, entities=entity_table)
+            prompts.append(prompt)
+            text_by_prompt[prompt] = text
+            names_by_prompt[prompt] = names
+            lookups[prompt] = lookup
+        if skipped:
+            print(f"Skipping {skipped} chunks that mention fewer than 2 known entities")
+        
+        # Prompts embed the chunk text and entity list, so their hash identifies the request
+        prompt_ids = {prompt: PromptCache.make_key(prompt) for prompt in prompts}
+        done = self._load_checkpoint(checkpoint_file) if checkpoint_file else {}
+        pending = [prompt for prompt in dict.fromkeys(prompts) if prompt_ids[prompt] not in done]
+        if done:
+            print(f"Resuming: {len(prompt_ids) - len(pending)} chunks already processed")
+        
+        checkpoint = open(checkpoint_file, 'ab') if checkpoint_file else None
+        
+        def record(prompt: str, result: Dict[str, Any], lookup: Dict[str, str]):
+            rel_objects = self._parse_relationships(result, lookup)
+            done[prompt_ids[prompt]] = rel_objects
+            # Failed or empty extractions aren't checkpointed, so a resumed run retries them
+            if checkpoint and rel_objects:
+                checkpoint.write(orjson.dumps({
+                    "id": prompt_ids[prompt],
+                    "relationships": [rel.model_dump() for rel in rel_objects]
+                }) + b"\n")
+                checkpoint.flush()
+        
+        try:
+            if batch_size > 1 and len(pending) > 1:
+                batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+                batch_prompts = {}
+                for batch in batches:
+                    names = set().union(*(names_by_prompt[prompt] for prompt in batch))
+                    entity_table, lookup = self._entity_table(sorted(names, key=entity_order.__getitem__))
+                    batch_prompt = self._batch_prompt([text_by_prompt[prompt] for prompt in batch], entity_table)
+                    batch_prompts[batch_prompt] = (batch, lookup)
+                failed = []
+                
+                def record_batch(batch_prompt: str, result: Dict[str, Any]):
+                    batch, lookup = batch_prompts[batch_prompt]
+                    records = self._split_records(result, len(batch))
+                    if records is None:
+                        failed.extend(batch)
+                        return
+                    for prompt, chunk_result in zip(batch, records):
+                        record(prompt, chunk_result, lookup)
+                
+                results = self._run_requests(
+                    list(batch_prompts), self.BATCH_EXTRACTION_INSTRUCTIONS, BatchRelationshipExtraction,
+                    record_batch, concurrency, batch_file
+                )
+                for (batch, _), result in zip(batch_prompts.values(), results):
+                    if isinstance(result, Exception):
+                        failed.extend(batch)
+                pending = failed
+                if pending:
+                    print(f"Retrying {len(pending)} chunks from incomplete batches one by one")
+            
+            results = self._run_requests(
+                pending, self.RELATIONSHIP_EXTRACTION_INSTRUCTIONS, RelationshipExtraction,
+                lambda prompt, result: record(prompt, result, lookups[prompt]),
+                concurrency, batch_file
+            )
+        finally:
+            if checkpoint:
+                checkpoint.close()
+        
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Error extracting relationships from chunk: {result}")
+        
+        # Merge in chunk order so the outcome matches sequential processing
+        for prompt in prompts:
+            self.relationships.extend(done.get(prompt_ids[prompt], []))
         
         # Deduplicate relationships
         self.relationships = self._deduplicate_relationships(self.relationships)
         
         return self.relationships
     
+    def _run_requests(
+        self, 
+        prompts: List[str], 
+        system_instruction: str,
+        response_schema: type,
+        on_result: Callable[[str, Dict[str, Any]], None],
+        concurrency: Optional[int],
+        batch_file: Optional[Path]
+    ) -> List[Union[Dict[str, Any], Exception]]:
+        """Send prompts in real time or as a Batch API job, reporting each success to on_result"""
+        if not prompts:
+            return []
+        
+        if batch_file is None:
+            return asyncio.run(self.client.generate_json_batch(
+                prompts, temperature=0.3, concurrency=concurrency, desc="Extracting relationships",
+                system_instruction=system_instruction, on_result=on_result,
+                response_schema=response_schema
+            ))
+        
+        results = self.client.generate_json_batch_job(
+            prompts, batch_file, temperature=0.3, system_instruction=system_instruction
+        )
+        for prompt, result in zip(prompts, results):
+            if not isinstance(result, Exception):
+                on_result(prompt, result)
+        return results
+    
+    def _batch_prompt(self, texts: List[str], entity_table: str) -> str:
+        """Pack several chunk texts into one prompt, numbered by record_id"""
+        records = self.RECORD_SEPARATOR.join(
+            self.RECORD_PROMPT.format(record_id=i, text=text) for i, text in enumerate(texts)
+        )
+        return self.BATCH_PROMPT.format(entities=entity_table, records=records)
+    
+    def _get_automaton(self, entity_names: List[str]) -> ahocorasick.Automaton:
+        """Aho-Corasick automaton over entity_names, rebuilt only when the names change"""
+        # A repeated name would overwrite its earlier entry and never match the saved list
+        entity_names = list(dict.fromkeys(entity_names))
+        if self._automaton_names != entity_names:
+            automaton = self._load_automaton(entity_names)
+            if automaton is None:
+                automaton = ahocorasick.Automaton()
+                for index, name in enumerate(entity_names):
+                    automaton.add_word(name, (index, name))
+                automaton.make_automaton()
+                if self.automaton_file:
+                    self.automaton_file.parent.mkdir(parents=True, exist_ok=True)
+                    automaton.save(str(self.automaton_file), pickle.dumps)
+            self._automaton = automaton
+            self._automaton_names = entity_names
+        return self._automaton
+    
+    def _load_automaton(self, entity_names: List[str]) -> Optional[ahocorasick.Automaton]:
+        """Automaton saved by a previous run, if it was built over the same entity_names"""
+        if not (self.automaton_file and self.automaton_file.exists()):
+            return None
+        try:
+            automaton = ahocorasick.load(str(self.automaton_file), pickle.loads)
+        except Exception as e:
+            print(f"Ignoring unreadable automaton file {self.automaton_file}: {e}")
+            return None
+        # Values are (index, name), so the stored name list can be checked directly
+        names = [name for _, name in sorted(automaton.values())]
+        return automaton if names == entity_names else None
+    
+    @staticmethod
+    def _find_entities(automaton: ahocorasick.Automaton, text: str) -> List[str]:
+        """Known entity names occurring in text, in entity list order"""
+        hits = {value for _, value in automaton.iter(text)}
+        return [name for _, name in sorted(hits)]
+    
+    @staticmethod
+    def _entity_table(names: List[str]) -> Tuple[str, Dict[str, str]]:
+        """
+        Number entities for a prompt
+        
+        Returns:
+            The "E1=name" table and a lookup from ID (or full name) to entity name
+        """
+        ids = {f"E{i}": name for i, name in enumerate(names, 1)}
+        table = "\n".join(f"{entity_id}={name}" for entity_id, name in ids.items())
+        # Accept full names too, in case the model doesn't use the IDs
+        lookup = {name: name for name in names}
+        lookup.update(ids)
+        return table, lookup
+    
+    @staticmethod
+    def _split_records(result: Dict[str, Any], count: int) -> Optional[List[Dict[str, Any]]]:
+        """Per-chunk results from a batched response, or None if any record is missing"""
+        records = {}
+        for record in result.get("records", []):
+            if isinstance(record, dict) and isinstance(record.get("record_id"), int):
+                records[record["record_id"]] = record
+        
+        if set(records) != set(range(count)):
+            return None
+        return [records[i] for i in range(count)]
+    
+    @staticmethod
+    def _load_checkpoint(checkpoint_file: Path) -> Dict[str, List[Relationship]]:
+        """Load {prompt id: relationships} recorded by an earlier, interrupted run"""
+        done = {}
+        if not checkpoint_file.exists():
+            return done
+        with open(checkpoint_file, 'rb') as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # Truncated last line from an interrupted write
+                    continue
+                done[record["id"]] = RELATIONSHIP_LIST.validate_python(record["relationships"])
+        return done
+    
     def _deduplicate_relationships(self, relationships: List[Relationship]) -> List[Relationship]:
         """
         Deduplicate and merge similar relationships
         
-        Two relationships are considered the same if they have the same source and target
+        Two relationships are considered the same if they have the same source and target.
+        The strongest one wins; descriptions and attitudes of equally strong ones are joined.
         """
-        rel_dict = {}
+        # (source, target) -> [strongest relationship, descriptions, attitudes]
+        # Dicts keep first-seen order and give O(1) membership checks
+        merged = {}
         
         for rel in relationships:
-            key = f"{rel.source}||{rel.target}"
+            key = (rel.source, rel.target)
+            entry = merged.get(key)
             
-            if key in rel_dict:
-                # Merge: keep the one with higher strength
-                existing = rel_dict[key]
-                if rel.strength > existing.strength:
-                    rel_dict[key] = rel
-                elif rel.strength == existing.strength:
-                    # Merge descriptions
-                    if rel.description not in existing.description:
-                        existing.description += f"; {rel.description}"
-                    # Merge attitudes
-                    if rel.attitude and existing.attitude:
-                        if rel.attitude not in existing.attitude:
-                            existing.attitude += f"; {rel.attitude}"
-                    elif rel.attitude and not existing.attitude:
-                        existing.attitude = rel.attitude
-            else:
-                rel_dict[key] = rel
-        
-        return list(rel_dict.values())
+            if entry is None or rel.strength > entry[0].strength:
+                merged[key] = [rel, {rel.description: None}, {rel.attitude: None} if rel.attitude else {}]
+            elif rel.strength == entry[0].strength:
+                entry[1][rel.description] = None
+                if rel.attitude:
+                    entry[2][rel.attitude] = None
+        
+        return [
+            Relationship(
+                source=best.source,
+                target=best.target,
+                description="; ".join(descriptions),
+                attitude="; ".join(attitudes) or None,
+                strength=best.strength
+            )
+            for best, descriptions, attitudes in merged.values()
+        ]
     
     def save_relationships(self, output_file: Path):
         """Save extracted relationships to file"""
         output_data = [rel.model_dump() for rel in self.relationships]
         
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, ensure_ascii=False, indent=2)
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(output_data, option=orjson.OPT_INDENT_2))
         
         print(f"Saved {len(output_data)} relationships to {output_file}")
 
@@ -209,10 +486,18 @@ if __name__ == "__main__":
         }
     
     # Extract relationships
-    client = GeminiClient(config.GEMINI_API_KEY, config.GEMINI_MODEL)
-    extractor = RelationshipExtractor(client)
+    client = GeminiClient(
+        config.GEMINI_API_KEY, 
+        config.GEMINI_MODEL, 
+        config.LLM_CONCURRENCY,
+        cache=PromptCache(config.PROMPT_CACHE_DIR),
+        transport=config.GEMINI_TRANSPORT
+    )
+    extractor = RelationshipExtractor(client, automaton_file=config.KG_DIR / "entities.aho")
     
-    relationships = extractor.process_chunks(chunks, entities)
+    relationships = extractor.process_chunks(
+        chunks, entities, checkpoint_file=config.OUTPUT_DIR / "relationships_partial.jsonl"
+    )
     
     # Save results
     output_file = config.KG_DIR / "relationships.json"
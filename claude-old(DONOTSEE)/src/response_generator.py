@@ -6,12 +6,13 @@ from pathlib import Path
 import json
 
 from .gemini_client import GeminiClient
+from .prompt_utils import PromptTemplate
 
 
 class ResponseGenerator:
     """Generate role-playing responses using LLM"""
     
-    RESPONSE_GENERATION_PROMPT = """
+    RESPONSE_GENERATION_PROMPT = PromptTemplate("""
 你现在要扮演原神游戏中的角色来回答问题。
 
 用户问题：{query}
@@ -30,16 +31,16 @@ class ResponseGenerator:
 5. 如果信息不足以回答，可以诚实地表示不清楚
 
 直接给出角色的回答，不要包含任何元信息或解释。
-"""
+""")
 
-    SUMMARY_GENERATION_PROMPT = """
+    SUMMARY_GENERATION_PROMPT = PromptTemplate("""
 请为以下对话生成一个简洁的摘要（50字以内）。
 
 问题：{query}
 回答：{response}
 
 直接返回摘要文本。
-"""
+""")
     
     def __init__(self, gemini_client: GeminiClient):
         self.client = gemini_client
@@ -54,51 +55,49 @@ class ResponseGenerator:
         Returns:
             Formatted context string
         """
-        context_parts = []
-        
-        for i, chunk in enumerate(retrieved_info):
-            context_parts.append(f"### 信息块 {i + 1}")
-            context_parts.append(f"查询类型：{chunk.get('type', 'unknown')}")
-            
-            # Add entity information
-            entities = chunk.get("entities", [])
-            if entities:
-                context_parts.append("\n**相关实体：**")
-                for entity in entities[:5]:  # Limit to top 5
-                    name = entity.get("name", "")
-                    if entity.get("type") == "character":
-                        persona = entity.get("persona", "")
-                        style = entity.get("style_description", "")
-                        exemplars = entity.get("style_exemplars", [])
-                        context_parts.append(f"- {name}：{persona}")
-                        if style:
-                            context_parts.append(f"  说话风格：{style}")
-                        if exemplars:
-                            context_parts.append(f"  惯用语：{', '.join(exemplars[:3])}")
-                    else:
-                        desc = entity.get("description", "")
-                        context_parts.append(f"- {name}：{desc}")
-                    
-                    # Add relationships
-                    neighbors = entity.get("neighbors", [])
-                    if neighbors:
-                        rel_strs = []
-                        for nb in neighbors[:3]:  # Limit to top 3
-                            rel_str = f"{nb['name']}({nb.get('relationship', '')})"
-                            rel_strs.append(rel_str)
-                        context_parts.append(f"  关系：{', '.join(rel_strs)}")
-            
-            # Add community summaries
-            communities = chunk.get("communities", [])
-            if communities:
-                context_parts.append("\n**相关社区：**")
-                for comm in communities[:2]:  # Limit to top 2
-                    summary = comm.get("summary", "")
-                    context_parts.append(f"- {summary}")
-            
-            context_parts.append("")
-        
-        return "\n".join(context_parts)
+        return "\n".join(self._format_chunk(i, chunk) for i, chunk in enumerate(retrieved_info, 1))
+    
+    def _format_chunk(self, number: int, chunk: Dict[str, Any]) -> str:
+        """Format one retrieved information chunk as a context block"""
+        lines = [f"### 信息块 {number}", f"查询类型：{chunk.get('type', 'unknown')}"]
+        
+        # Add entity information
+        entities = chunk.get("entities", [])
+        if entities:
+            lines.append("\n**相关实体：**")
+            lines.extend(self._format_entity(entity) for entity in entities[:5])  # Limit to top 5
+        
+        # Add community summaries
+        communities = chunk.get("communities", [])
+        if communities:
+            lines.append("\n**相关社区：**")
+            lines.extend(f"- {comm.get('summary', '')}" for comm in communities[:2])  # Limit to top 2
+        
+        lines.append("")
+        return "\n".join(lines)
+    
+    @staticmethod
+    def _format_entity(entity: Dict[str, Any]) -> str:
+        """Format an entity with its style (characters) and top relationships"""
+        name = entity.get("name", "")
+        if entity.get("type") == "character":
+            lines = [f"- {name}：{entity.get('persona', '')}"]
+            style = entity.get("style_description", "")
+            exemplars = entity.get("style_exemplars", [])
+            if style:
+                lines.append(f"  说话风格：{style}")
+            if exemplars:
+                lines.append(f"  惯用语：{', '.join(exemplars[:3])}")
+        else:
+            lines = [f"- {name}：{entity.get('description', '')}"]
+        
+        # Add relationships
+        neighbors = entity.get("neighbors", [])
+        if neighbors:
+            relations = ", ".join(f"{nb['name']}({nb.get('relationship', '')})" for nb in neighbors[:3])  # Limit to top 3
+            lines.append(f"  关系：{relations}")
+        
+        return "\n".join(lines)
     
     def extract_character_info(self, retrieved_info: List[Dict[str, Any]]) -> str:
         """
@@ -110,18 +109,16 @@ class ResponseGenerator:
         Returns:
             Character info string
         """
-        # Find the main character entity
-        main_character = None
-        
-        for chunk in retrieved_info:
-            entities = chunk.get("entities", [])
-            for entity in entities:
-                if entity.get("type") == "character":
-                    # Assume first character entity is the main one
-                    main_character = entity
-                    break
-            if main_character:
-                break
+        # Assume the first character entity is the main one
+        main_character = next(
+            (
+                entity 
+                for chunk in retrieved_info 
+                for entity in chunk.get("entities", []) 
+                if entity.get("type") == "character"
+            ),
+            None
+        )
         
         if not main_character:
             return "未找到明确的角色信息。"
@@ -3,20 +3,29 @@ Agent-based retrieval system with query decomposition and iterative search
 """
 from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
-import json
+from collections import OrderedDict
+import re
+import unicodedata
 import networkx as nx
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy.sparse import vstack
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.metrics.pairwise import linear_kernel
 import numpy as np
+import orjson
 
 from .gemini_client import GeminiClient
+from .prompt_utils import PromptTemplate, dumps_truncated
+from .graph_io import load_graph, has_graph
 from models.schema import Query, SubQuery
 
 
 class RetrievalAgent:
     """Agent for schema-aware query decomposition and iterative retrieval"""
     
-    QUERY_DECOMPOSITION_PROMPT = """
+    DECOMPOSITION_CACHE_SIZE = 256
+    
+    QUERY_DECOMPOSITION_PROMPT = PromptTemplate("""
 你是一个专业的查询分析助手。请分析用户的问题，并将其分解为多个子查询。
 
 用户问题：{query}
@@ -40,9 +49,9 @@ class RetrievalAgent:
     }}
   ]
 }}
-"""
+""")
 
-    REFLECTION_PROMPT = """
+    REFLECTION_PROMPT = PromptTemplate("""
 你是一个专业的信息充分性评估助手。请评估当前检索到的信息是否足以回答用户的问题。
 
 用户问题：{query}
@@ -64,7 +73,7 @@ class RetrievalAgent:
     "priority": 1
   }}
 }}
-"""
+""")
     
     def __init__(
         self, 
@@ -78,27 +87,82 @@ class RetrievalAgent:
         self.entities = entities
         self.client = gemini_client
         
+        # Normalized query -> sub-queries, most recently used last
+        self._decomp_cache: "OrderedDict[str, List[SubQuery]]" = OrderedDict()
+        
         # Create TF-IDF index for entities
         self._build_entity_index()
         
         # Create TF-IDF index for communities
         self._build_community_index()
+        
+        # Flatten node attributes and adjacency for entity lookups
+        self._build_adjacency()
     
     def _build_entity_index(self):
         """Build TF-IDF index for entity search"""
         self.entity_names = list(self.graph.nodes())
-        entity_texts = []
+        entity_texts = [self._entity_text(name) for name in self.entity_names]
         
-        for name in self.entity_names:
-            node_data = self.graph.nodes[name]
-            if node_data.get("type") == "character":
-                text = f"{name} {node_data.get('persona', '')} {node_data.get('avatarDetail', '')}"
-            else:
-                text = f"{name} {node_data.get('description', '')}"
-            entity_texts.append(text)
-        
-        self.entity_vectorizer = TfidfVectorizer()
+        self.entity_vectorizer = _tfidf_pipeline()
         self.entity_tfidf = self.entity_vectorizer.fit_transform(entity_texts)
+        
+        is_character = np.array(
+            [self.graph.nodes[name].get("type") == "character" for name in self.entity_names], dtype=bool
+        )
+        self._entity_masks = {"character": is_character, "event": ~is_character}
+    
+    def _entity_text(self, name: str) -> str:
+        """Text indexed for an entity"""
+        node_data = self.graph.nodes[name]
+        if node_data.get("type") == "character":
+            return f"{name} {node_data.get('persona', '')} {node_data.get('avatarDetail', '')}"
+        return f"{name} {node_data.get('description', '')}"
+    
+    def add_entity(self, name: str):
+        """
+        Index an entity added to the graph after the agent was built
+        
+        The new row reuses the fitted IDF weights, so only this entity's
+        text is vectorized.
+        
+        Args:
+            name: Name of a node already present in self.graph
+        """
+        if name in self._name_to_idx:
+            return
+        
+        self.entity_names.append(name)
+        self.entity_tfidf = vstack(
+            [self.entity_tfidf, self.entity_vectorizer.transform([self._entity_text(name)])], format="csr"
+        )
+        is_character = self.graph.nodes[name].get("type") == "character"
+        self._entity_masks = {
+            "character": np.append(self._entity_masks["character"], is_character),
+            "event": np.append(self._entity_masks["event"], not is_character)
+        }
+        
+        # New edges also change existing nodes' neighbor lists
+        self._build_adjacency()
+    
+    def _build_adjacency(self):
+        """Build per-node attribute list and CSR neighbor records aligned with entity_names"""
+        self._name_to_idx = {name: i for i, name in enumerate(self.entity_names)}
+        self._node_data = [self.graph.nodes[name] for name in self.entity_names]
+        
+        # Neighbors of node i are _neighbor_records[_adj_indptr[i]:_adj_indptr[i + 1]]
+        indptr = [0]
+        self._neighbor_records: List[Dict[str, Any]] = []
+        for name in self.entity_names:
+            for neighbor, edge_data in self.graph.adj[name].items():
+                self._neighbor_records.append({
+                    "name": neighbor,
+                    "relationship": edge_data.get("description", ""),
+                    "attitude": edge_data.get("attitude"),
+                    "strength": edge_data.get("strength", 0.5)
+                })
+            indptr.append(len(self._neighbor_records))
+        self._adj_indptr = np.array(indptr, dtype=np.intp)
     
     def _build_community_index(self):
         """Build TF-IDF index for community search"""
@@ -107,8 +171,21 @@ class RetrievalAgent:
             text = f"{comm['summary']} {' '.join(comm['members'])}"
             community_texts.append(text)
         
-        self.community_vectorizer = TfidfVectorizer()
+        self.community_vectorizer = _tfidf_pipeline()
         self.community_tfidf = self.community_vectorizer.fit_transform(community_texts)
+        
+        # Few communities: keep a dense copy restricted to the hashed features they use,
+        # and a feature -> column map for scattering query vectors into it
+        used = np.unique(self.community_tfidf.indices)
+        self._community_dense = np.ascontiguousarray(self.community_tfidf[:, used].toarray(), dtype=np.float32)
+        self._community_columns = np.full(self.community_tfidf.shape[1], -1, dtype=np.int32)
+        self._community_columns[used] = np.arange(len(used), dtype=np.int32)
+        
+        community_types = np.array([comm["type"] for comm in self.communities], dtype=object)
+        self._community_masks = {
+            "character": community_types == "character-focused",
+            "event": community_types == "event-focused"
+        }
     
     def decompose_query(self, query: str) -> List[SubQuery]:
         """
@@ -120,6 +197,13 @@ class RetrievalAgent:
         Returns:
             List of SubQuery objects
         """
+        # Repeated queries differing only in case or spacing reuse the earlier decomposition
+        cache_key = " ".join(query.split()).casefold()
+        cached = self._decomp_cache.get(cache_key)
+        if cached is not None:
+            self._decomp_cache.move_to_end(cache_key)
+            return list(cached)
+        
         prompt = self.QUERY_DECOMPOSITION_PROMPT.format(query=query)
         
         try:
@@ -134,12 +218,19 @@ class RetrievalAgent:
                 except Exception as e:
                     print(f"Error creating SubQuery: {e}")
             
-            return sorted(subqueries, key=lambda x: x.priority)
+            # Only remember real decompositions; an empty one is retried next time
+            if subqueries:
+                subqueries.sort(key=lambda x: x.priority)
+                self._decomp_cache[cache_key] = subqueries
+                if len(self._decomp_cache) > self.DECOMPOSITION_CACHE_SIZE:
+                    self._decomp_cache.popitem(last=False)
+                return list(subqueries)
             
         except Exception as e:
             print(f"Error decomposing query: {e}")
-            # Fallback: treat entire query as a single sub-query
-            return [SubQuery(text=query, type="character", priority=1)]
+        
+        # Fallback: treat entire query as a single sub-query
+        return [SubQuery(text=query, type="character", priority=1)]
     
     def search_entities(self, query: str, query_type: str, top_k: int = 5) -> List[str]:
         """
@@ -153,31 +244,18 @@ class RetrievalAgent:
         Returns:
             List of entity names
         """
-        # Vectorize query
-        query_vec = self.entity_vectorizer.transform([query])
+        mask = self._entity_masks.get(query_type)
+        if mask is None:
+            return []
         
-        # Calculate similarities
-        similarities = cosine_similarity(query_vec, self.entity_tfidf)[0]
+        # Vectorize query; TF-IDF rows are L2-normalized, so the dot product is the cosine
+        query_vec = self.entity_vectorizer.transform([query])
+        similarities = linear_kernel(query_vec, self.entity_tfidf).ravel()
         
-        # Get top-k indices
-        top_indices = np.argsort(similarities)[::-1][:top_k * 2]  # Get more candidates
+        # Rows sharing no terms with the query aren't matches
+        mask = mask & (similarities > 0)
         
-        # Filter by type
-        results = []
-        for idx in top_indices:
-            entity_name = self.entity_names[idx]
-            entity_data = self.graph.nodes[entity_name]
-            
-            # Type filtering
-            if query_type == "character" and entity_data.get("type") == "character":
-                results.append(entity_name)
-            elif query_type == "event" and entity_data.get("type") != "character":
-                results.append(entity_name)
-            
-            if len(results) >= top_k:
-                break
-        
-        return results
+        return [self.entity_names[idx] for idx in _top_k(similarities, mask, top_k)]
     
     def search_communities(self, query: str, query_type: str, top_k: int = 3) -> List[Dict[str, Any]]:
         """
@@ -193,50 +271,29 @@ class RetrievalAgent:
         """
         # Vectorize query
         query_vec = self.community_vectorizer.transform([query])
+        columns = self._community_columns[query_vec.indices]
+        known = columns >= 0
+        query_dense = np.zeros(self._community_dense.shape[1], dtype=np.float32)
+        query_dense[columns[known]] = query_vec.data[known]
+        similarities = self._community_dense @ query_dense
         
-        # Calculate similarities
-        similarities = cosine_similarity(query_vec, self.community_tfidf)[0]
-        
-        # Get top-k indices
-        top_indices = np.argsort(similarities)[::-1][:top_k * 2]
-        
-        # Filter by type
-        results = []
-        for idx in top_indices:
-            community = self.communities[idx]
-            
-            # Type filtering: match community type with query type
-            if query_type == "character" and community["type"] == "character-focused":
-                results.append(community)
-            elif query_type == "event" and community["type"] == "event-focused":
-                results.append(community)
-            elif query_type not in ["character", "event"]:  # Accept any type
-                results.append(community)
-            
-            if len(results) >= top_k:
-                break
+        # Match community type with query type; other query types accept any community
+        mask = self._community_masks.get(query_type)
+        mask = similarities > 0 if mask is None else mask & (similarities > 0)
         
-        return results
+        return [self.communities[idx] for idx in _top_k(similarities, mask, top_k)]
     
     def retrieve_entity_info(self, entity_name: str) -> Dict[str, Any]:
         """Get detailed information about an entity"""
-        if entity_name not in self.graph.nodes:
+        idx = self._name_to_idx.get(entity_name)
+        if idx is None:
             return {}
         
-        node_data = dict(self.graph.nodes[entity_name])
+        node_data = dict(self._node_data[idx])
         
         # Get neighbors and relationships
-        neighbors = []
-        for neighbor in self.graph.neighbors(entity_name):
-            edge_data = self.graph.edges[entity_name, neighbor]
-            neighbors.append({
-                "name": neighbor,
-                "relationship": edge_data.get("description", ""),
-                "attitude": edge_data.get("attitude"),
-                "strength": edge_data.get("strength", 0.5)
-            })
-        
-        node_data["neighbors"] = neighbors
+        start, end = self._adj_indptr[idx], self._adj_indptr[idx + 1]
+        node_data["neighbors"] = [dict(record) for record in self._neighbor_records[start:end]]
         return node_data
     
     def retrieve_subquery(
@@ -294,7 +351,7 @@ class RetrievalAgent:
             (is_sufficient, new_subquery)
         """
         # Format retrieved info for prompt
-        info_summary = json.dumps(retrieved_info, ensure_ascii=False, indent=2)[:2000]  # Limit length
+        info_summary = dumps_truncated(retrieved_info, 2000, indent=2)  # Limit length
         
         prompt = self.REFLECTION_PROMPT.format(
             query=query,
@@ -324,7 +381,8 @@ class RetrievalAgent:
     def retrieve(
         self, 
         query: str, 
-        max_iterations: int = 5
+        max_iterations: int = 5,
+        max_entities: int = 5
     ) -> List[Dict[str, Any]]:
         """
         Main retrieval pipeline with iterative refinement
@@ -332,12 +390,21 @@ class RetrievalAgent:
         Args:
             query: User query
             max_iterations: Maximum retrieval iterations
+            max_entities: Maximum number of entities to retrieve per sub-query
             
         Returns:
             List of retrieved information chunks
         """
         print(f"Query: {query}")
         
+        # A query that is just an entity name needs neither decomposition nor reflection
+        entity_name = query.strip()
+        idx = self._name_to_idx.get(entity_name)
+        if idx is not None:
+            query_type = "character" if self._entity_masks["character"][idx] else "event"
+            print(f"Direct entity lookup: {entity_name}")
+            return [self.retrieve_subquery(SubQuery(text=entity_name, type=query_type, priority=1), max_entities)]
+        
         # Step 1: Decompose query
         print("Decomposing query...")
         subqueries = self.decompose_query(query)
@@ -348,9 +415,15 @@ class RetrievalAgent:
         
         for sq in subqueries:
             print(f"Retrieving for: {sq.text} (type: {sq.type})")
-            retrieved = self.retrieve_subquery(sq)
+            retrieved = self.retrieve_subquery(sq, max_entities)
             all_retrieved.append(retrieved)
         
+        # Skip reflection when every sub-query already found enough
+        if self._has_coverage(all_retrieved, max_entities):
+            print("All sub-queries covered, skipping reflection")
+            print(f"\nTotal retrieved chunks: {len(all_retrieved)}")
+            return all_retrieved
+        
         # Step 3: Iterative reflection
         iteration = 0
         while iteration < max_iterations:
@@ -368,13 +441,89 @@ class RetrievalAgent:
             
             if new_subquery:
                 print(f"Retrieving additional info for: {new_subquery.text}")
-                retrieved = self.retrieve_subquery(new_subquery)
+                retrieved = self.retrieve_subquery(new_subquery, max_entities)
                 all_retrieved.append(retrieved)
             
             iteration += 1
         
         print(f"\nTotal retrieved chunks: {len(all_retrieved)}")
         return all_retrieved
+    
+    @staticmethod
+    def _has_coverage(all_retrieved: List[Dict[str, Any]], max_entities: int) -> bool:
+        """Whether every sub-query matched at least half of max_entities entities and a community"""
+        return bool(all_retrieved) and all(
+            len(retrieved["entities"]) >= max_entities // 2 and retrieved["communities"]
+            for retrieved in all_retrieved
+        )
+
+
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+# A run of CJK characters, or a word without any
+_TOKEN_RE = re.compile(f"([{_CJK}]+)|([^\\W{_CJK}]+)")
+
+
+def _analyze(text: str) -> List[str]:
+    """
+    Tokenize text for the TF-IDF indexes
+    
+    Text is NFKC-normalized (folding full-width forms) and lowercased.
+    CJK runs, which have no word boundaries, become overlapping character
+    bigrams; other scripts become whole words.
+    
+    Args:
+        text: Document or query text
+        
+    Returns:
+        Tokens
+    """
+    tokens = []
+    for cjk, word in _TOKEN_RE.findall(unicodedata.normalize("NFKC", text).lower()):
+        if word:
+            tokens.append(word)
+        elif len(cjk) == 1:
+            tokens.append(cjk)
+        else:
+            tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return tokens
+
+
+def _tfidf_pipeline() -> Pipeline:
+    """
+    TF-IDF vectorizer over hashed features
+    
+    Hashing needs no vocabulary, so documents added later are vectorized
+    with the IDF weights from the initial fit.
+    
+    Returns:
+        Unfitted pipeline producing L2-normalized float32 TF-IDF rows
+    """
+    return make_pipeline(
+        HashingVectorizer(
+            analyzer=_analyze, n_features=2 ** 18, alternate_sign=False, norm=None, dtype=np.float32
+        ),
+        TfidfTransformer()
+    )
+
+
+def _top_k(scores: np.ndarray, mask: Optional[np.ndarray], k: int) -> np.ndarray:
+    """
+    Indices of the k highest scores among the masked-in entries, best first
+    
+    Args:
+        scores: Score per item
+        mask: Items eligible for selection (None for all)
+        k: Number of results
+        
+    Returns:
+        Index array of at most k items
+    """
+    candidates = np.flatnonzero(mask) if mask is not None else np.arange(len(scores))
+    if k <= 0 or not len(candidates):
+        return candidates[:0]
+    if k < len(candidates):
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
 
 
 if __name__ == "__main__":
@@ -387,13 +536,12 @@ if __name__ == "__main__":
         sys.exit(1)
     
     # Load graph
-    graph_file = config.KG_DIR / "knowledge_graph.graphml"
-    if not graph_file.exists():
-        print(f"Error: {graph_file} not found.")
+    if not has_graph(config.KG_DIR):
+        print(f"Error: no knowledge graph found in {config.KG_DIR}.")
         sys.exit(1)
     
     print("Loading knowledge graph...")
-    graph = nx.read_graphml(graph_file)
+    graph = load_graph(config.KG_DIR)
     
     # Load communities
     communities_file = config.KG_DIR / "communities.json"
@@ -401,13 +549,13 @@ if __name__ == "__main__":
         print(f"Error: {communities_file} not found.")
         sys.exit(1)
     
-    with open(communities_file, 'r', encoding='utf-8') as f:
-        communities = json.load(f)
+    with open(communities_file, 'rb') as f:
+        communities = orjson.loads(f.read())
     
     # Load entities (for reference)
     entities_file = config.KG_DIR / "entities_deduplicated.json"
-    with open(entities_file, 'r', encoding='utf-8') as f:
-        entities = json.load(f)
+    with open(entities_file, 'rb') as f:
+        entities = orjson.loads(f.read())
     
     # Initialize agent
     client = GeminiClient(config.GEMINI_API_KEY, config.GEMINI_MODEL)
@@ -420,7 +568,7 @@ if __name__ == "__main__":
     
     # Save test results
     output_file = config.OUTPUT_DIR / "test_retrieval.json"
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(retrieved_info, f, ensure_ascii=False, indent=2)
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(retrieved_info, option=orjson.OPT_INDENT_2))
     
     print(f"\nSaved test results to {output_file}")
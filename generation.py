@@ -1,7 +1,7 @@
-from typing import List, Dict, Any
-from utils import get_gemini_model
+from typing import List, Dict, Any, Optional
+from utils import get_gemini_model, generate_text, PromptTemplate
 
-GENERATION_PROMPT = """
+GENERATION_PROMPT = PromptTemplate("""
 You are playing the role of **{role}**.
 Your goal is to answer the user's question based ONLY on the provided context, while strictly adhering to your character's persona and style.
 
@@ -18,28 +18,31 @@ Your goal is to answer the user's question based ONLY on the provided context, w
 4. Do NOT mention that you are an AI or that you were given context.
 
 **Response**:
-"""
+""")
+
+# Responses depend on live context, so cached ones expire
+RESPONSE_CACHE_TTL = 3600  # seconds
 
 class Generator:
-    def __init__(self, role: str = "Harry Potter"):
+    def __init__(self, role: str = "Harry Potter", use_cache: bool = True):
         self.model = get_gemini_model()
         self.role = role
+        self.use_cache = use_cache
 
     def assemble_context(self, retrieved_info: str) -> str:
         """Formats the retrieved info for the prompt."""
         # In a real system, we might re-rank or filter here.
         return retrieved_info
 
-    def generate_response(self, query: str, context: str) -> str:
-        """Generates the final response."""
+    def generate_response(self, query: str, context: str, role: Optional[str] = None) -> str:
+        """Generates the final response, in the voice of `role` (default: self.role)."""
         prompt = GENERATION_PROMPT.format(
-            role=self.role,
+            role=role or self.role,
             context=context,
             query=query
         )
         try:
-            response = self.model.generate_content(prompt)
-            return response.text
+            return generate_text(self.model, prompt, use_cache=self.use_cache, ttl=RESPONSE_CACHE_TTL)
         except Exception as e:
             print(f"Error generating response: {e}")
             return "I... I can't speak right now."
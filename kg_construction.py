@@ -1,42 +1,80 @@
 import os
 import glob
-import json
-import networkx as nx
-from tqdm import tqdm
-from typing import List, Dict, Any
-from utils import get_gemini_model, parse_json_response
+import asyncio
+import argparse
+import hashlib
+import math
 import time
+import orjson
+import networkx as nx
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pandas as pd
+from tqdm.asyncio import tqdm as tqdm_asyncio
+from google.api_core import exceptions as google_exceptions
+from typing import List, Dict, Any, Callable, Optional, Tuple
+from utils import get_gemini_model, parse_json_response, run_batch_job, generate_text, drop_cached_text, PromptTemplate
 
 # Configuration
 DATASET_DIR = "/root/RoleRAG/datasets/harry-potter"
 OUTPUT_DIR = "/root/RoleRAG/output"
 CHUNK_SIZE = 1000  # Characters
 OVERLAP = 100
+MAX_CONCURRENCY = 8  # Gemini requests in flight during extraction
+MAX_QPS = 4  # Gemini requests started per second during extraction
+MAX_RETRIES = 5  # Attempts per chunk when the API reports the quota is exhausted
+BACKOFF_SECONDS = 1.0  # First retry delay; doubles on each further attempt
+CHECKPOINT_FILE = os.path.join(OUTPUT_DIR, "kg_checkpoint.jsonl")
+NODE_COLUMNS = ["name", "type", "persona", "style_description", "style_exemplars", "description"]
+EDGE_COLUMNS = ["source", "target", "description", "attitude", "strength"]
 
 # Ensure output directory exists
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-def load_documents(directory: str) -> List[str]:
-    """Loads all .txt files from the directory."""
+def load_documents(directory: str, workers: Optional[int] = None) -> List[str]:
+    """Loads all .txt files from the directory, reading them on a thread pool."""
     files = glob.glob(os.path.join(directory, "*.txt"))
     files.sort() # Ensure order
-    documents = []
-    for fpath in files:
-        with open(fpath, "r", encoding="utf-8") as f:
-            documents.append(f.read())
-    return documents
+    # Reads are I/O bound, so threads avoid pickling every file's text back from a worker process
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map (not as_completed) keeps the file order
+        return list(executor.map(_read_text, files))
+
+def _read_text(path: str) -> str:
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8")
 
 def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = OVERLAP) -> List[str]:
     """Splits text into overlapping chunks."""
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = start + chunk_size
-        chunks.append(text[start:end])
-        start += chunk_size - overlap
-    return chunks
-
-EXTRACTION_PROMPT = """
+    step = chunk_size - overlap
+    return [text[start:start + chunk_size] for start in range(0, len(text), step)]
+
+def chunk_documents(documents: List[str], workers: Optional[int] = None) -> List[List[str]]:
+    """Chunks each document, in parallel processes when there are several."""
+    if len(documents) < 2:
+        return [chunk_text(doc) for doc in documents]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(chunk_text, documents))
+
+def chunk_id(doc_idx: int, chunk_idx: int, text: str) -> str:
+    """Stable ID for a chunk, used to skip already-extracted chunks on resume."""
+    return hashlib.sha256(f"{doc_idx}|{chunk_idx}|{text[:64]}".encode("utf-8")).hexdigest()[:16]
+
+def load_checkpoint(path: str = CHECKPOINT_FILE) -> Dict[str, Dict[str, Any]]:
+    """Loads {chunk_id: extraction result} from a checkpoint file, if one exists."""
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # Truncated last line from an interrupted run
+            results[record["id"]] = record["result"]
+    return results
+
+# Fixed instructions, sent once through Gemini context caching
+EXTRACTION_INSTRUCTIONS = """
 You are an expert Knowledge Graph builder for a Role-Playing System.
 Your task is to extract entities and relations from the provided text chunk of the Harry Potter series.
 
@@ -63,29 +101,117 @@ Extract the following:
 
 **Output Format**:
 Return a JSON object with two keys: "entities" (list) and "relations" (list).
+"""
 
-Text Chunk:
+# Per-chunk prompt
+CHUNK_PROMPT = PromptTemplate("""Text Chunk:
 {text}
-"""
+""")
 
-def extract_entities_relations(model, text_chunk: str) -> Dict[str, Any]:
+def extract_entities_relations(model, text_chunk: str, use_cache: bool = True) -> Dict[str, Any]:
     """Extracts entities and relations using Gemini."""
-    prompt = EXTRACTION_PROMPT.format(text=text_chunk)
     try:
-        response = model.generate_content(prompt)
-        return parse_json_response(response.text)
+        return _extract(model, text_chunk, use_cache)
     except Exception as e:
         print(f"Error extracting from chunk: {e}")
         return {"entities": [], "relations": []}
 
-def build_graph_from_documents(documents: List[str], limit_chunks: int = None):
-    """Main function to process docs and build the graph."""
-    model = get_gemini_model()
-    G = nx.MultiDiGraph() # Use MultiDiGraph to allow multiple relations between nodes
-    
+def _extract(model, text_chunk: str, use_cache: bool) -> Dict[str, Any]:
+    prompt = CHUNK_PROMPT.format(text=text_chunk)
+    data = parse_json_response(generate_text(
+        model, prompt, use_cache=use_cache, system_instruction=EXTRACTION_INSTRUCTIONS
+    ))
+    # Don't keep an unparseable response cached forever; ask again next run
+    if not data and use_cache:
+        drop_cached_text(model, prompt, system_instruction=EXTRACTION_INSTRUCTIONS)
+    return data
+
+class AsyncRateLimiter:
+    """Token bucket shared by coroutines: at most `rate` acquisitions per `period` seconds."""
+
+    def __init__(self, rate: float, period: float = 1.0):
+        self.capacity = rate
+        self.fill_rate = rate / period
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Waiters queue on the lock, so tokens are handed out in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+
+async def _extract_with_backoff(model, text_chunk: str, use_cache: bool, limiter: AsyncRateLimiter) -> Dict[str, Any]:
+    """Runs _extract under the rate limit, backing off exponentially on 429 responses."""
+    for attempt in range(MAX_RETRIES):
+        await limiter.acquire()
+        try:
+            # The SDK call blocks, so run it on a worker thread
+            return await asyncio.to_thread(_extract, model, text_chunk, use_cache)
+        except google_exceptions.ResourceExhausted:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(BACKOFF_SECONDS * 2 ** attempt)
+
+async def extract_all_async(model, chunks: List[str], concurrency: int = MAX_CONCURRENCY, use_cache: bool = True,
+                            on_result: Optional[Callable[[int, Dict[str, Any]], None]] = None,
+                            qps: float = MAX_QPS) -> List[Dict[str, Any]]:
+    """
+    Extracts entities and relations from all chunks concurrently, preserving chunk order.
+    At most `concurrency` requests are in flight and at most `qps` start per second.
+    on_result(index, data) is called as each chunk succeeds; failed chunks are not reported.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = AsyncRateLimiter(qps)
+
+    async def extract(i: int, chunk: str) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                data = await _extract_with_backoff(model, chunk, use_cache, limiter)
+            except Exception as e:
+                print(f"Error extracting from chunk: {e}")
+                return {"entities": [], "relations": []}
+        if on_result:
+            on_result(i, data)
+        return data
+
+    return await tqdm_asyncio.gather(*(extract(i, chunk) for i, chunk in enumerate(chunks)))
+
+def extract_all_batch(chunks: List[str], on_result: Optional[Callable[[int, Dict[str, Any]], None]] = None) -> List[Dict[str, Any]]:
+    """Extracts entities and relations from all chunks with one offline Batch API job."""
+    prompts = {f"chunk_{i}": CHUNK_PROMPT.format(text=chunk) for i, chunk in enumerate(chunks)}
+    responses = run_batch_job(
+        prompts, os.path.join(OUTPUT_DIR, "batch_requests.jsonl"), system_instruction=EXTRACTION_INSTRUCTIONS
+    )
+
+    results = []
+    for i, key in enumerate(prompts):
+        if key in responses:
+            data = parse_json_response(responses[key])
+            if on_result:
+                on_result(i, data)
+            results.append(data)
+        else:
+            results.append({"entities": [], "relations": []})
+    return results
+
+def build_tables_from_documents(documents: List[str], limit_chunks: int = None, concurrency: int = MAX_CONCURRENCY, use_batch_api: bool = False, use_cache: bool = True,
+                                checkpoint_file: Optional[str] = CHECKPOINT_FILE) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Extracts entities and relations from the docs into node and edge tables.
+    Each extracted chunk is appended to checkpoint_file, so an interrupted run
+    resumes where it stopped; pass checkpoint_file=None to disable.
+    """
     all_chunks = []
-    for doc in documents:
-        all_chunks.extend(chunk_text(doc))
+    for doc_idx, doc_chunks in enumerate(chunk_documents(documents)):
+        all_chunks.extend((chunk_id(doc_idx, i, chunk), chunk) for i, chunk in enumerate(doc_chunks))
     
     if limit_chunks:
         all_chunks = all_chunks[:limit_chunks]
@@ -93,51 +219,152 @@ def build_graph_from_documents(documents: List[str], limit_chunks: int = None):
     else:
         print(f"Processing all {len(all_chunks)} chunks")
 
-    for i, chunk in tqdm(enumerate(all_chunks), total=len(all_chunks)):
-        data = extract_entities_relations(model, chunk)
-        
-        # Add Entities
+    done = load_checkpoint(checkpoint_file) if checkpoint_file else {}
+    pending = [(cid, chunk) for cid, chunk in all_chunks if cid not in done]
+    if done:
+        print(f"Resuming: {len(all_chunks) - len(pending)} chunks already extracted")
+
+    checkpoint = open(checkpoint_file, "ab") if checkpoint_file else None
+
+    def record(i: int, data: Dict[str, Any]):
+        cid = pending[i][0]
+        done[cid] = data
+        # Failed or empty extractions aren't checkpointed, so a resumed run retries them
+        if checkpoint and (data.get("entities") or data.get("relations")):
+            checkpoint.write(orjson.dumps({"id": cid, "result": data}) + b"\n")
+            checkpoint.flush()
+
+    try:
+        pending_texts = [chunk for _, chunk in pending]
+        if use_batch_api:
+            extract_all_batch(pending_texts, on_result=record)
+        else:
+            asyncio.run(extract_all_async(get_gemini_model(), pending_texts, concurrency, use_cache, on_result=record))
+    finally:
+        if checkpoint:
+            checkpoint.close()
+
+    # Merge in chunk order so the tables match sequential processing
+    return results_to_tables([done[cid] for cid, _ in all_chunks if cid in done])
+
+def results_to_tables(results: List[Dict[str, Any]]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Collects extraction results into node and edge tables, one column per attribute.
+    Entities are merged by name: the first mention's attributes win and style exemplars
+    are unioned. Relation endpoints that were never extracted as entities get type "unknown".
+    """
+    # Merge by integer node id in one pass; columns are built once at the end
+    name_to_idx: Dict[str, int] = {}
+    nodes: List[Dict[str, Any]] = []
+    exemplars: List[Dict[str, None]] = []  # Ordered sets of quotes per node
+    relations: List[Dict[str, Any]] = []
+
+    def node_id(name: str, entity: Dict[str, Any]) -> int:
+        idx = name_to_idx.setdefault(name, len(nodes))
+        if idx == len(nodes):
+            nodes.append(entity)
+            exemplars.append({})
+        return idx
+
+    for data in results:
         for entity in data.get("entities", []):
-            name = entity.get("name")
+            name = _as_text(entity.get("name"))
             if not name: continue
-            
-            # Simple merging: if node exists, update attributes (naive approach)
-            # Ideally we would do sophisticated disambiguation here
-            if not G.has_node(name):
-                G.add_node(name, **entity)
-            else:
-                # Merge list fields like exemplars
-                if "style_exemplars" in entity and "style_exemplars" in G.nodes[name]:
-                     # Avoid duplicates
-                     current_exemplars = set(G.nodes[name]["style_exemplars"])
-                     new_exemplars = set(entity["style_exemplars"])
-                     G.nodes[name]["style_exemplars"] = list(current_exemplars.union(new_exemplars))
-        
-        # Add Relations
+            idx = node_id(name, entity)
+            quotes = entity.get("style_exemplars")
+            if isinstance(quotes, list):
+                exemplars[idx].update(dict.fromkeys(map(str, quotes)))
+
         for relation in data.get("relations", []):
-            src = relation.get("source")
-            tgt = relation.get("target")
-            if src and tgt:
-                # Ensure nodes exist (sometimes relation extracted but entity missed in same chunk)
-                if not G.has_node(src): G.add_node(src, type="unknown")
-                if not G.has_node(tgt): G.add_node(tgt, type="unknown")
-                
-                G.add_edge(src, tgt, **relation)
-        
-        # Rate limit handling (simple sleep)
-        time.sleep(1) 
+            if relation.get("source") and relation.get("target"):
+                relations.append(relation)
+
+    # Relations sometimes mention entities the same chunk didn't extract
+    for relation in relations:
+        for end in ("source", "target"):
+            name = _as_text(relation[end])
+            if name not in name_to_idx:
+                node_id(name, {"type": "unknown"})
+
+    nodes_df = pd.DataFrame.from_records(nodes, columns=NODE_COLUMNS)
+    nodes_df["name"] = list(name_to_idx)
+    nodes_df["style_exemplars"] = [list(quotes) or None for quotes in exemplars]
+    edges_df = pd.DataFrame.from_records(relations, columns=EDGE_COLUMNS)
 
+    # LLM output is loosely typed; normalize so the columns have one type each
+    for column in ("type", "persona", "style_description", "description"):
+        nodes_df[column] = nodes_df[column].map(_as_text)
+    for column in ("source", "target", "description", "attitude"):
+        edges_df[column] = edges_df[column].map(_as_text)
+    edges_df["strength"] = pd.to_numeric(edges_df["strength"], errors="coerce")
+
+    return nodes_df, edges_df
+
+def tables_to_graph(nodes_df: pd.DataFrame, edges_df: pd.DataFrame) -> nx.MultiDiGraph:
+    """Materializes node and edge tables as a MultiDiGraph, omitting missing attributes."""
+    G = nx.MultiDiGraph() # Use MultiDiGraph to allow multiple relations between nodes
+    G.add_nodes_from(
+        (record["name"], {k: v for k, v in record.items() if not _is_missing(v)})
+        for record in nodes_df.to_dict("records")
+    )
+    G.add_edges_from(
+        (record["source"], record["target"], {k: v for k, v in record.items() if not _is_missing(v)})
+        for record in edges_df.to_dict("records")
+    )
     return G
 
+def build_graph_from_documents(documents: List[str], limit_chunks: int = None, concurrency: int = MAX_CONCURRENCY, use_batch_api: bool = False, use_cache: bool = True,
+                               checkpoint_file: Optional[str] = CHECKPOINT_FILE) -> nx.MultiDiGraph:
+    """Main function to process docs and build the graph."""
+    return tables_to_graph(*build_tables_from_documents(
+        documents, limit_chunks, concurrency, use_batch_api, use_cache, checkpoint_file
+    ))
+
+def save_tables(nodes_df: pd.DataFrame, edges_df: pd.DataFrame, prefix: str = "role_rag"):
+    """Saves the node and edge tables as Parquet."""
+    for name, df in (("nodes", nodes_df), ("edges", edges_df)):
+        path = os.path.join(OUTPUT_DIR, f"{prefix}_{name}.parquet")
+        df.to_parquet(path, compression="zstd", index=False)
+        print(f"Table saved to {path}")
+
+def _as_text(value: Any) -> Any:
+    return value if _is_missing(value) or isinstance(value, str) else str(value)
+
+def _is_missing(value: Any) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
 def save_graph(G, filename="role_rag_graph.json"):
-    """Saves the graph to a JSON file (node-link data)."""
-    data = nx.node_link_data(G)
+    """
+    Saves the graph to a JSON file (node-link data, as read by nx.node_link_graph).
+    Nodes and edges are encoded and written one per line, so the full node-link
+    dict is never built in memory.
+    """
     path = os.path.join(OUTPUT_DIR, filename)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    if G.is_multigraph():
+        edges = ({**data, "source": u, "target": v, "key": k} for u, v, k, data in G.edges(keys=True, data=True))
+    else:
+        edges = ({**data, "source": u, "target": v} for u, v, data in G.edges(data=True))
+    with open(path, "wb") as f:
+        header = {"directed": G.is_directed(), "multigraph": G.is_multigraph(), "graph": G.graph}
+        f.write(orjson.dumps(header, option=orjson.OPT_SERIALIZE_NUMPY)[:-1] + b',\n"nodes":')
+        _write_json_array(f, ({**data, "id": n} for n, data in G.nodes(data=True)))
+        f.write(b',\n"edges":')
+        _write_json_array(f, edges)
+        f.write(b"}\n")
     print(f"Graph saved to {path}")
 
+def _write_json_array(f, records):
+    f.write(b"[")
+    for i, record in enumerate(records):
+        f.write(b",\n" if i else b"\n")
+        f.write(orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY))
+    f.write(b"\n]")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the Harry Potter knowledge graph")
+    parser.add_argument("--no-cache", action="store_true", help="always call Gemini, ignoring cached responses")
+    args = parser.parse_args()
+
     # Test run with a small subset
     docs = load_documents(DATASET_DIR)
     # Take only the first book for testing, or just a few chunks
@@ -154,5 +381,6 @@ if __name__ == "__main__":
     
     print("Starting KG Construction (Test Run)...")
     # Re-chunking inside, so we just pass the first few KB of text
-    G = build_graph_from_documents([first_book[:5000]], limit_chunks=5)
-    save_graph(G)
+    nodes_df, edges_df = build_tables_from_documents([first_book[:5000]], limit_chunks=5, use_cache=not args.no_cache)
+    save_tables(nodes_df, edges_df)
+    save_graph(tables_to_graph(nodes_df, edges_df))
@@ -1,9 +1,10 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import uvicorn
 import os
-import json
+import asyncio
+import hashlib
 import networkx as nx
 from retrieval_agent import RetrievalAgent
 from generation import Generator
@@ -26,6 +27,9 @@ GRAPH_PATH = "/root/RoleRAG/output/role_rag_graph.json"
 agent = None
 generator = None
 memory = None
+# Gemini calls in flight across all /chat requests
+LLM_CONCURRENCY = 16
+llm_limit = asyncio.Semaphore(LLM_CONCURRENCY)
 
 class ChatRequest(BaseModel):
     message: str
@@ -49,18 +53,34 @@ async def startup_event():
     generator = Generator() # Default role, will update per request
     memory = MemoryManager()
 
+# Raw bytes of the graph file, reloaded only when its mtime changes
+_graph_cache = {"mtime": None, "body": b"", "etag": ""}
+
+def load_graph_bytes() -> Dict[str, Any]:
+    """Returns the cached graph file bytes and ETag, re-reading the file if it changed."""
+    mtime = os.stat(GRAPH_PATH).st_mtime_ns
+    if _graph_cache["mtime"] != mtime:
+        with open(GRAPH_PATH, "rb") as f:
+            body = f.read()
+        _graph_cache.update(mtime=mtime, body=body, etag=f'"{hashlib.md5(body).hexdigest()}"')
+    return _graph_cache
+
 @app.get("/graph")
-async def get_graph():
+async def get_graph(request: Request):
     """Returns the Knowledge Graph for visualization."""
     if not os.path.exists(GRAPH_PATH):
         return {"nodes": [], "links": []}
     
     try:
-        with open(GRAPH_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data
+        cached = load_graph_bytes()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    
+    # Clients revalidate with If-None-Match and get an empty 304 while the graph is unchanged
+    headers = {"ETag": cached["etag"], "Cache-Control": "no-cache"}
+    if request.headers.get("If-None-Match") == cached["etag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached["body"], media_type="application/json", headers=headers)
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
@@ -76,7 +96,8 @@ async def chat(request: ChatRequest):
     retrieved_context = ""
     if agent:
         try:
-            retrieved_context = agent.retrieve(query)
+            async with llm_limit:
+                retrieved_context = await agent.retrieve(query)
         except Exception as e:
             print(f"Retrieval failed: {e}")
             retrieved_context = "Error retrieving info."
@@ -85,14 +106,17 @@ async def chat(request: ChatRequest):
     full_context = f"{history_context}\n---\n{retrieved_context}"
     
     # 4. Generation
-    generator.role = role
+    # The role is passed per call, since concurrent requests share the generator
     try:
-        response_text = generator.generate_response(query, full_context)
+        # Blocking Gemini calls run on worker threads so other requests are served meanwhile
+        async with llm_limit:
+            response_text = await asyncio.to_thread(generator.generate_response, query, full_context, role)
     except Exception as e:
         response_text = "I cannot answer right now."
         print(f"Generation failed: {e}")
 
     # 5. Update Memory
+    # Returns at once; the turn summary is generated in the background
     memory.add_turn(query, response_text)
     
     return ChatResponse(response=response_text, context=full_context)
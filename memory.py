@@ -1,3 +1,5 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List, Dict, Any
 from utils import get_gemini_model
 
@@ -16,20 +18,35 @@ class MemoryManager:
         self.history: List[Dict[str, str]] = [] # List of {role: ..., content: ...}
         self.summaries: List[str] = []
         self.model = get_gemini_model()
+        # One worker, so summaries land in turn order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-summary")
+        self._pending: List[Future] = []
+        self._lock = threading.Lock()
 
     def add_turn(self, user_query: str, ai_response: str):
-        """Adds a turn to history and generates a summary."""
+        """Adds a turn to history; its summary is generated in the background."""
         self.history.append({"role": "user", "content": user_query})
         self.history.append({"role": "assistant", "content": ai_response})
         
-        # Generate summary
+        # Don't hold up the reply for another LLM round trip
+        self._pending = [f for f in self._pending if not f.done()]
+        self._pending.append(self._executor.submit(self._summarize, user_query, ai_response))
+
+    def _summarize(self, user_query: str, ai_response: str):
         try:
             prompt = SUMMARY_PROMPT.format(user_query=user_query, ai_response=ai_response)
             response = self.model.generate_content(prompt)
-            self.summaries.append(response.text)
+            with self._lock:
+                self.summaries.append(response.text)
         except Exception as e:
             print(f"Error generating summary: {e}")
 
+    def wait_for_summaries(self):
+        """Blocks until every scheduled summary has been added."""
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
     def get_recent_context(self, k: int = 3) -> str:
         """Returns the last k turns formatted as text."""
         recent = self.history[-2*k:]
@@ -43,13 +60,16 @@ class MemoryManager:
         # In a real system, we would use an LLM to classify if the query needs history
         # and which summaries are relevant.
         # Here we just return all summaries as context if the history is short.
-        if not self.summaries:
+        with self._lock:
+            summaries = list(self.summaries)
+        if not summaries:
             return ""
         
-        return "Previous Context:\n" + "\n".join(self.summaries)
+        return "Previous Context:\n" + "\n".join(summaries)
 
 if __name__ == "__main__":
     mem = MemoryManager()
     mem.add_turn("Who are you?", "I am Harry Potter.")
+    mem.wait_for_summaries()
     print(mem.get_recent_context())
     print(mem.check_callback("What did I just ask?"))
@@ -1,6 +1,9 @@
-import json
+import re
+import asyncio
+import orjson
 import networkx as nx
-from typing import List, Dict, Any, Tuple
+from collections import Counter, defaultdict
+from typing import List, Dict, Any, Optional, Tuple
 from utils import get_gemini_model, parse_json_response
 
 DECOMPOSITION_PROMPT = """
@@ -40,19 +43,90 @@ If YES, return {{ "sufficient": true }}.
 If NO, return {{ "sufficient": false, "missing_info": "...", "new_sub_queries": [...] }}.
 """
 
+class LiteGraph:
+    """
+    Read-only view of node-link graph data: a node attribute dict plus out-edge lists.
+    Supports the part of the nx.MultiDiGraph API that search_graph uses.
+    """
+
+    def __init__(self, nodes: Dict[str, Dict[str, Any]], out: Dict[str, List[Tuple[str, Dict[str, Any]]]]):
+        self.nodes = nodes
+        self._out = out
+
+    @classmethod
+    def from_node_link(cls, data: Dict[str, Any]) -> "LiteGraph":
+        """Builds the graph in one pass, reusing the parsed record dicts as attribute dicts."""
+        nodes = {}
+        for record in data.get("nodes", []):
+            nodes[record.pop("id")] = record
+        out = {}
+        for record in data.get("edges", data.get("links", [])):
+            source, target = record.pop("source"), record.pop("target")
+            record.pop("key", None)
+            nodes.setdefault(source, {})
+            nodes.setdefault(target, {})
+            out.setdefault(source, []).append((target, record))
+        return cls(nodes, out)
+
+    def out_edges(self, node: str, data: bool = False) -> List[tuple]:
+        if data:
+            return [(node, target, attrs) for target, attrs in self._out.get(node, ())]
+        return [(node, target) for target, _ in self._out.get(node, ())]
+
 class RetrievalAgent:
-    def __init__(self, graph_path: str):
+    def __init__(self, graph_path: str, lite: bool = True):
         self.model = get_gemini_model()
-        self.graph = self._load_graph(graph_path)
+        self.graph = self._load_graph(graph_path, lite)
+        self._build_name_index()
     
-    def _load_graph(self, path: str) -> nx.MultiDiGraph:
+    def _load_graph(self, path: str, lite: bool = True):
+        """Loads the node-link JSON as a LiteGraph, or as a full nx.MultiDiGraph if lite=False."""
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            return nx.node_link_graph(data)
+            with open(path, "rb") as f:
+                data = orjson.loads(f.read())
+            return LiteGraph.from_node_link(data) if lite else nx.node_link_graph(data)
         except Exception as e:
             print(f"Error loading graph: {e}")
-            return nx.MultiDiGraph()
+            return LiteGraph({}, {}) if lite else nx.MultiDiGraph()
+
+    def _build_name_index(self):
+        """Indexes node names by lowercase name and by lowercase word token."""
+        self._order = {}  # node -> position in graph order, for tie-breaking
+        self._token_count = {}
+        self._by_lower = {}
+        self._by_token = defaultdict(list)
+        for i, node in enumerate(self.graph.nodes):
+            tokens = set(re.findall(r"\w+", node.lower()))
+            self._order[node] = i
+            self._token_count[node] = len(tokens)
+            self._by_lower.setdefault(node.lower(), node)
+            for token in tokens:
+                self._by_token[token].append(node)
+
+    def _match_nodes(self, target: str, top_k: int = 3) -> List[str]:
+        """
+        Resolves an entity name to nodes: an exact (case-insensitive) name match alone, else the
+        top_k nodes by share of the target's tokens they contain (ties go to the node with fewer
+        extra tokens), else the first node that contains or is contained in the name.
+        """
+        if not target:
+            return []
+        target_lower = target.lower()
+        if target_lower in self._by_lower:
+            return [self._by_lower[target_lower]]
+
+        overlap = Counter()
+        for token in set(re.findall(r"\w+", target_lower)):
+            overlap.update(self._by_token.get(token, ()))
+        if overlap:
+            # Dividing by the target's token count is the same for every node, so rank on raw overlap
+            ranked = sorted(overlap, key=lambda node: (-overlap[node], self._token_count[node], self._order[node]))
+            return ranked[:top_k]
+
+        for node in self.graph.nodes:
+            if target_lower in node.lower() or node.lower() in target_lower:
+                return [node]
+        return []
 
     def decompose_query(self, query: str) -> List[Dict[str, str]]:
         """Decomposes query into sub-queries."""
@@ -61,24 +135,24 @@ class RetrievalAgent:
         data = parse_json_response(response.text)
         return data.get("sub_queries", [])
 
-    def search_graph(self, sub_query: Dict[str, str]) -> str:
-        """Searches the graph for a specific sub-query."""
+    def search_graph(self, sub_query: Dict[str, str], top_k: int = 3) -> str:
+        """Searches the graph for a specific sub-query, combining info from the top_k matching entities."""
         target = sub_query.get("target_entity")
         q_type = sub_query.get("type")
         
-        results = []
-        
-        # Fuzzy match for entity name (simple implementation)
-        # In production, use vector search or exact match with aliases
-        matched_node = None
-        for node in self.graph.nodes():
-            if target.lower() in node.lower() or node.lower() in target.lower():
-                matched_node = node
-                break
+        matched_nodes = self._match_nodes(target, top_k)
         
-        if not matched_node:
+        if not matched_nodes:
             return f"No information found for entity: {target}"
         
+        results = []
+        for matched_node in matched_nodes:
+            self._describe_node(matched_node, q_type, results)
+
+        return "\n".join(results)
+
+    def _describe_node(self, matched_node: str, q_type: Optional[str], results: List[str]):
+        """Appends the info lines for one matched node to results."""
         node_data = self.graph.nodes[matched_node]
         
         if q_type == "character_info":
@@ -105,25 +179,28 @@ class RetrievalAgent:
              for u, v, data in edges:
                 results.append(f"Related to {v}: {data.get('description')}")
 
-        return "\n".join(results)
+    def reflect(self, query: str, info: str) -> Dict[str, Any]:
+        """Asks the model whether the gathered info is sufficient to answer the query."""
+        prompt = REFLECTION_PROMPT.format(query=query, info=info)
+        response = self.model.generate_content(prompt)
+        return parse_json_response(response.text)
 
-    def retrieve(self, query: str) -> str:
-        """Main retrieval loop with reflection."""
+    async def retrieve(self, query: str) -> str:
+        """
+        Main retrieval loop with reflection. The blocking Gemini calls run on worker
+        threads so the event loop stays free while they are in flight.
+        """
         print(f"Processing Query: {query}")
-        sub_queries = self.decompose_query(query)
+        sub_queries = await asyncio.to_thread(self.decompose_query, query)
         print(f"Sub-queries: {sub_queries}")
         
-        all_info = []
-        for sq in sub_queries:
-            info = self.search_graph(sq)
-            all_info.append(info)
+        # Graph lookups are in-memory, so they run inline
+        all_info = [self.search_graph(sq) for sq in sub_queries]
         
         combined_info = "\n---\n".join(all_info)
         
         # Reflection step (simplified: just check once)
-        prompt = REFLECTION_PROMPT.format(query=query, info=combined_info)
-        response = self.model.generate_content(prompt)
-        reflection = parse_json_response(response.text)
+        reflection = await asyncio.to_thread(self.reflect, query, combined_info)
         
         if not reflection.get("sufficient", True):
             print("Info insufficient, retrieving more...")
@@ -134,10 +211,14 @@ class RetrievalAgent:
         
         return combined_info
 
+    def retrieve_sync(self, query: str) -> str:
+        """Blocking wrapper around retrieve for callers without an event loop."""
+        return asyncio.run(self.retrieve(query))
+
 if __name__ == "__main__":
     # Test
     agent = RetrievalAgent("/root/RoleRAG/output/role_rag_graph.json")
     # Assuming we have some data in the graph from the previous step
     # Let's try a query that might be in the first few chunks of Harry Potter
     q = "Who is Harry Potter and what are his relationships?"
-    print(agent.retrieve(q))
+    print(agent.retrieve_sync(q))
@@ -1,8 +1,17 @@
 import os
-import json
+import re
+import time
+import hashlib
+import sqlite3
+import string
+import threading
+import zlib
+from functools import lru_cache
+import orjson
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 # Load environment variables
 load_dotenv()
@@ -15,33 +24,255 @@ if not GENAI_API_KEY:
 
 genai.configure(api_key=GENAI_API_KEY)
 
-def get_gemini_model(model_name="gemini-2.5-pro"):
-    """Returns a configured Gemini model instance."""
-    generation_config = {
-        "temperature": 0.1, # Low temperature for factual extraction
-        "top_p": 0.95,
-        "top_k": 64,
-        "max_output_tokens": 8192,
-        "response_mime_type": "application/json",
-    }
+DEFAULT_MODEL = "gemini-2.5-pro"
+GENERATION_CONFIG = {
+    "temperature": 0.1, # Low temperature for factual extraction
+    "top_p": 0.95,
+    "top_k": 64,
+    "max_output_tokens": 8192,
+    "response_mime_type": "application/json",
+}
+
+# Terminal Batch API job states
+BATCH_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+# On-disk response cache
+RESPONSE_CACHE_PATH = os.getenv("GEMINI_CACHE_PATH", ".gemini_cache.sqlite3")
+
+class ResponseCache:
+    """SQLite-backed cache of zlib-compressed Gemini responses with optional per-entry TTL."""
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH):
+        # Shared by the extraction worker threads, so serialize access ourselves
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)"
+            )
+
+    @staticmethod
+    def make_key(model_name: str, temperature: float, prompt: str) -> str:
+        return hashlib.sha256(f"{model_name}|{temperature}|{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            self.delete(key)
+            return None
+        return zlib.decompress(value).decode("utf-8")
+
+    def put(self, key: str, value: str, ttl: Optional[float] = None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, zlib.compress(value.encode("utf-8")), expires_at),
+            )
+
+    def delete(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+_response_cache = None
+
+def get_response_cache() -> ResponseCache:
+    """Returns the process-wide response cache, opening it on first use."""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+def generate_text(model, prompt: str, use_cache: bool = True, ttl: Optional[float] = None,
+                  system_instruction: Optional[str] = None) -> str:
+    """
+    Calls model.generate_content and returns the response text, memoized on disk
+    by (prompt, model, temperature). ttl=None caches forever (KG extraction);
+    pass a TTL for prompts that embed live context. A system_instruction is sent
+    through Gemini context caching (see get_cached_model) instead of with the prompt.
+    """
+    if not use_cache:
+        return _generate(model, prompt, system_instruction)
+
+    cache = get_response_cache()
+    key = _response_key(model, prompt, system_instruction)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    text = _generate(model, prompt, system_instruction)
+    cache.put(key, text, ttl)
+    return text
+
+def drop_cached_text(model, prompt: str, system_instruction: Optional[str] = None):
+    """Removes a generate_text response from the cache, e.g. after it failed to parse."""
+    get_response_cache().delete(_response_key(model, prompt, system_instruction))
+
+def _response_key(model, prompt: str, system_instruction: Optional[str]) -> str:
+    key_prompt = f"{system_instruction}|{prompt}" if system_instruction else prompt
+    return ResponseCache.make_key(model.model_name, GENERATION_CONFIG["temperature"], key_prompt)
+
+def _generate(model, prompt: str, system_instruction: Optional[str]) -> str:
+    if not system_instruction:
+        return model.generate_content(prompt).text
+    try:
+        return get_cached_model(system_instruction, model.model_name).generate_content(prompt).text
+    except google_exceptions.NotFound:
+        # The cached content expired server-side; upload it again and retry once
+        _cached_models.pop((system_instruction, model.model_name), None)
+        return get_cached_model(system_instruction, model.model_name).generate_content(prompt).text
+
+# Gemini context caching for fixed instruction blocks
+CONTEXT_CACHE_TTL = 3600  # seconds
+_cached_models = {}  # (system_instruction, model_name) -> (model, cached content or None, expires_at)
+_cached_models_lock = threading.Lock()
+
+def get_cached_model(system_instruction: str, model_name: str = DEFAULT_MODEL, ttl: int = CONTEXT_CACHE_TTL):
+    """
+    Returns a model whose system instruction is uploaded once as Gemini cached content,
+    so it is billed at the cached rate instead of being re-sent with every request.
+    The cache TTL is extended as it nears expiry. If caching is unavailable (e.g. the
+    instruction is below the model's minimum cacheable size), the instruction is sent
+    as a plain system instruction instead.
+    """
+    key = (system_instruction, model_name)
+    with _cached_models_lock:
+        entry = _cached_models.get(key)
+        if entry is not None:
+            model, cached, expires_at = entry
+            # Extend the TTL once less than a tenth of it is left
+            if cached is None or time.time() < expires_at - ttl / 10:
+                return model
+            try:
+                cached.update(ttl=ttl)
+                _cached_models[key] = (model, cached, time.time() + ttl)
+                return model
+            except Exception as e:
+                print(f"Could not extend cached content, recreating it: {e}")
+
+        try:
+            cached = genai.caching.CachedContent.create(
+                model=model_name, system_instruction=system_instruction, ttl=ttl
+            )
+            model = genai.GenerativeModel.from_cached_content(cached, generation_config=GENERATION_CONFIG)
+            expires_at = time.time() + ttl
+        except Exception as e:
+            print(f"Context caching unavailable, using plain system instruction: {e}")
+            cached, expires_at = None, None
+            model = genai.GenerativeModel(
+                model_name=model_name,
+                generation_config=GENERATION_CONFIG,
+                system_instruction=system_instruction,
+            )
+        _cached_models[key] = (model, cached, expires_at)
+        return model
+
+@lru_cache(maxsize=None)
+def get_gemini_model(model_name=DEFAULT_MODEL):
+    """
+    Returns a configured Gemini model instance. Instances are shared per model name,
+    so the agent, generator and memory reuse one client connection.
+    """
     return genai.GenerativeModel(
         model_name=model_name,
-        generation_config=generation_config,
+        generation_config=GENERATION_CONFIG,
+    )
+
+def run_batch_job(prompts: Dict[str, str], request_file: str, model_name: str = DEFAULT_MODEL, poll_interval: int = 60,
+                  system_instruction: Optional[str] = None) -> Dict[str, str]:
+    """
+    Runs prompts as one offline Gemini Batch API job (half price, up to 24h latency).
+    Returns {key: response text} for every request that succeeded.
+    """
+    # Only needed for batch jobs; the legacy SDK has no Batch API
+    from google import genai as genai_sdk
+
+    with open(request_file, "wb") as f:
+        for key, prompt in prompts.items():
+            request = {
+                "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                "generation_config": GENERATION_CONFIG,
+            }
+            if system_instruction:
+                request["system_instruction"] = {"parts": [{"text": system_instruction}]}
+            f.write(orjson.dumps({"key": key, "request": request}) + b"\n")
+
+    client = genai_sdk.Client(api_key=GENAI_API_KEY)
+    uploaded = client.files.upload(
+        file=request_file,
+        config={"mime_type": "jsonl", "display_name": os.path.basename(request_file)},
     )
+    job = client.batches.create(model=model_name, src=uploaded.name)
+    print(f"Submitted batch job {job.name} with {len(prompts)} requests")
+
+    while job.state.name not in BATCH_DONE_STATES:
+        time.sleep(poll_interval)
+        job = client.batches.get(name=job.name)
+
+    if job.state.name not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+        raise RuntimeError(f"Batch job {job.name} ended in {job.state.name}: {job.error}")
+
+    results = {}
+    output = client.files.download(file=job.dest.file_name)
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        response = record.get("response")
+        if not response or not response.get("candidates"):
+            print(f"Batch request {record.get('key')} failed: {record.get('error')}")
+            continue
+        parts = response["candidates"][0].get("content", {}).get("parts", [])
+        results[record["key"]] = "".join(part.get("text", "") for part in parts)
+    return results
+
+# Optional markdown code fence (``` or ```json) around the JSON payload
+JSON_FENCE_RE = re.compile(r"^\s*(?:```(?:json)?)?(.*?)(?:```)?\s*$", re.DOTALL)
 
 def parse_json_response(response_text: str) -> Dict[str, Any]:
     """Parses JSON response from LLM, handling potential markdown code blocks."""
-    text = response_text.strip()
-    if text.startswith("```json"):
-        text = text[7:]
-    if text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
+    text = JSON_FENCE_RE.match(response_text).group(1)
     
     try:
-        return json.loads(text)
-    except json.JSONDecodeError as e:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError as e:
         print(f"Error decoding JSON: {e}")
         print(f"Raw text: {text}")
         return {}
+
+class PromptTemplate:
+    """A str.format prompt template split once into literal fragments and field names."""
+
+    def __init__(self, template: str):
+        self.template = template
+        self._pieces: List[Tuple[str, Optional[str]]] = []
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            if field is not None and (not field.isidentifier() or spec or conversion):
+                raise ValueError(f"Unsupported prompt field: {{{field}}}")
+            self._pieces.append((literal, field))
+
+    def format(self, **values: Any) -> str:
+        """Same result as template.format(**values), without re-parsing the template."""
+        parts = []
+        for literal, field in self._pieces:
+            parts.append(literal)
+            if field is not None:
+                parts.append(str(values[field]))
+        return "".join(parts)
+
+    def __str__(self) -> str:
+        return self.template